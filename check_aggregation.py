@@ -0,0 +1,129 @@
+'''
+Aggregation check
+
+Compares ninja_functions.aggregate_variables with the original loops of the pipeline (one pass over the table
+per month and per code, kept below as legacy_*) on a synthetic table of births, for the layouts
+the counting functions get:
+	csv 		codes as strings, NaN for missing data (the BigData csv)
+	read_csv 	the csv read without dtype=str: floats where data is missing
+	numpy 		plain numpy integer columns (int64, int8), a table without missing data
+	store 		nullable integers and categoricals (ninja_functions.decode_store_column, load_birth_store)
+	selection 	a ColumnSelection of any of them instead of a cleaned copy
+
+The specs are the ones of covidbirth.py. Every series, code and month must be the same.
+
+Usage:
+	python check_aggregation.py
+
+'''
+
+import ninja_functions
+## libraries
+import numpy as np
+import pandas as pd
+import io
+
+#################################################################################### original loops
+## the counting loops of covidbirth.py before the fused aggregation, on a cleaned copy of the table
+def legacy_clean(bigData, columns):
+	tab = bigData[['date']+columns].copy()
+	return tab.dropna(subset=columns+['date'])
+
+def legacy_sum(tab, var1):
+	time_series = np.sort(tab['date'].unique())
+	birthseries = np.array([])
+	for current_date in time_series:
+		birthseries = np.append(birthseries, np.sum(tab[var1][tab.date==current_date].values.astype(int)))
+	return time_series, None, birthseries
+
+def legacy_count(tab, var1):
+	time_series = np.sort(tab['date'].unique())
+	codes = np.unique(tab[var1].values.astype(int))
+	g = np.zeros((len(codes),len(time_series)))
+	for y in range(0,len(time_series)):
+		MAGE = tab[var1][tab.date==time_series[y]].values.astype(int)
+		for x in range(0,len(codes)):
+			g[x,y] = len(MAGE[MAGE==codes[x]])
+	return time_series, codes, g
+
+def legacy_letter(tab, var1):
+	time_series = np.sort(tab['date'].unique())
+	codes = np.unique(tab[var1].values)
+	g = np.zeros((len(codes),len(time_series)))
+	for y in range(0,len(time_series)):
+		MAGE = tab[var1][tab.date==time_series[y]]
+		for x in range(0,len(codes)):
+			g[x,y] = len(MAGE[MAGE==codes[x]])
+	return time_series, codes, g
+
+legacy_modes = {'sum': legacy_sum, 'count': legacy_count, 'letter': legacy_letter}
+
+#################################################################################### synthetic births
+def synthetic_births(n_rows=20000, seed=0):
+	''' BigData layout, as read from the csv: a YYYY-MM-01 date and string codes with missing data.
+	MAGER9 mixes '01' and '1' (the same code), RF_INFTR is a letter code'''
+	rng = np.random.default_rng(seed)
+	def codes(values, missing):
+		column = rng.choice(np.array(values, dtype=object), n_rows)
+		column[rng.random(n_rows)<missing] = np.nan
+		return column
+	dates = np.array(['%d-%02d-01' % (year_, month_) for year_ in [2019, 2020, 2021] for month_ in range(1, 13)], dtype=object)
+	## one month without any MEDUC, one without any date
+	date = rng.choice(dates[:-1], n_rows)
+	date[rng.random(n_rows)<0.01] = np.nan
+	bigData = pd.DataFrame({'date': date, 'DPLURAL': codes(['1','1','1','2','3'], 0.001),
+							'MAGER9': codes(['1','01','2','3','4','5','6','7','8','9'], 0.02),
+							'PREVIS_REC': codes(['1','2','3','4','5','6','7','8','9','10','11','12'], 0.05),
+							'MEDUC': codes(['1','2','3','4','5','6','7','8','9'], 0.05),
+							'RF_INFTR': codes(['Y','N','U'], 0.03)})
+	bigData.loc[bigData['date']==dates[5], 'MEDUC'] = np.nan
+	return bigData
+
+def numpy_layout(bigData, dtypes):
+	''' the rows without missing data, codes as plain numpy integers (letter codes stay strings)'''
+	tab = bigData.dropna().reset_index(drop=True)
+	for name, dtype in dtypes.items():
+		if dtype!='char':
+			tab[name] = tab[name].astype(int).astype(dtype)
+	return tab
+
+def store_layout(bigData, dtypes):
+	''' the table as load_birth_store returns it: encoded and decoded by the store, categorical date'''
+	tab = pd.DataFrame({'date': pd.Categorical(bigData['date'])})
+	for name, dtype in dtypes.items():
+		tab[name] = ninja_functions.decode_store_column(ninja_functions.encode_store_column(bigData[name], dtype), dtype)
+	return tab
+
+
+if __name__=='__main__':
+	specs = [('DPLURAL','sum'), ('MAGER9','count'),
+			('PREVIS_REC','count',['MEDUC']), ('MEDUC','count',['PREVIS_REC']),
+			('RF_INFTR','letter')]
+	dtypes = {'DPLURAL': 'int8', 'MAGER9': 'int8', 'PREVIS_REC': 'int8', 'MEDUC': 'int8', 'RF_INFTR': 'char'}
+	bigData = synthetic_births()
+	complete = bigData.dropna().reset_index(drop=True)
+	## layout: (table given to aggregate_variables, csv table of the original loops)
+	tables = {'csv': (bigData, bigData), 'read_csv': (pd.read_csv(io.StringIO(bigData.to_csv(index=False))), bigData),
+			'numpy int64': (numpy_layout(bigData, {name: 'int64' for name in dtypes if dtypes[name]!='char'}), complete),
+			'numpy int8': (numpy_layout(bigData, dtypes), complete), 'store': (store_layout(bigData, dtypes), bigData)}
+
+	failures = 0
+	for spec in specs:
+		var1, mode = spec[0], spec[1]
+		columns = [var1]+(list(spec[2]) if len(spec)>2 else [])
+		for layout, (tab, csv_table) in tables.items():
+			## the reference: the original loop on the cleaned csv table
+			time_series, codes, series = legacy_modes[mode](legacy_clean(csv_table, columns), var1)
+			for view in [False, True]:
+				table = ninja_functions.ColumnSelection(tab, ['date']+columns) if view else tab
+				result = ninja_functions.aggregate_variables(table, [spec])[var1]
+				same = (np.array_equal(np.asarray(result['time_series'], dtype=str), np.asarray(time_series, dtype=str))
+						and ((codes is None and result['codes'] is None)
+							or np.array_equal(np.asarray(result['codes']).astype(str), np.asarray(codes).astype(str)))
+						and np.array_equal(result['series'], series))
+				failures = failures+int(not same)
+				print(var1, mode, layout, 'ColumnSelection' if view else 'table', ': ', 'same' if same else 'DIFFERENT')
+
+	if failures>0:
+		raise SystemExit(str(failures)+' aggregations differ from the original loops')
+	print('every aggregation matches the original loops')
@@ -0,0 +1,66 @@
+'''
+Bitmap index check
+
+Builds the bitmap indexes of a temporary store (the synthetic year file of check_store.py) and compares
+ninja_functions.bitmap_count with pandas masks over load_birth_store, per month, for and/or/not predicates,
+lists of codes, a code without births, and a column without bitmaps (an error, not zero births).
+
+Usage:
+	python check_bitmaps.py
+
+'''
+
+import ninja_functions
+import check_store
+## libraries
+import numpy as np
+import pandas as pd
+import os
+import tempfile
+
+bitmap_columns = ['DPLURAL','MAGER9','PREVIS_REC','MEDUC','RF_INFTR']
+
+def mask_of(tab, predicate):
+	''' rows where predicate is true, with pandas (missing data is not equal to any code)'''
+	operator = predicate[0]
+	if operator in ['and', 'or']:
+		masks = [mask_of(tab, term) for term in predicate[1:]]
+		return np.logical_and.reduce(masks) if operator=='and' else np.logical_or.reduce(masks)
+	if operator=='not':
+		return ~mask_of(tab, predicate[1])
+	column, codes = predicate
+	return tab[column].isin(codes if np.ndim(codes)>0 else [codes]).fillna(False).to_numpy(dtype=bool)
+
+
+if __name__=='__main__':
+	predicates = [('MAGER9', 2), ('PREVIS_REC', [1,2]), ('RF_INFTR', 'Y'), ('MEDUC', 99),
+				('and', ('MAGER9', 2), ('PREVIS_REC', 1)),
+				('or', ('DPLURAL', [2,3]), ('RF_INFTR', 'U')),
+				('not', ('MEDUC', [1,2,3])),
+				('and', ('not', ('RF_INFTR', 'N')), ('or', ('MAGER9', [1,2]), ('MEDUC', 9)))]
+	failures = 0
+	with tempfile.TemporaryDirectory() as work_dir:
+		file_path = os.path.join(work_dir, 'nat2020us.csv')
+		store_dir = os.path.join(work_dir, 'birth_store')
+		check_store.write_year_file(file_path)
+		check_store.ingest_year_file(file_path, store_dir)
+		ninja_functions.build_bitmap_index(store_dir, bitmap_columns)
+		tab = ninja_functions.load_birth_store(store_dir, bitmap_columns)
+
+		for predicate in predicates:
+			time_series, counts = ninja_functions.bitmap_count(store_dir, predicate)
+			expected = pd.Series(mask_of(tab, predicate)).groupby(tab['date'].astype(str).to_numpy()).sum()
+			same = np.array_equal(time_series, expected.index.to_numpy(dtype=object)) and np.array_equal(counts, expected.to_numpy(dtype=float))
+			failures = failures+int(not same)
+			print(predicate, ': ', 'same' if same else 'DIFFERENT')
+
+		try:
+			ninja_functions.bitmap_count(store_dir, ('and', ('MAGER9', 2), ('DMAR', 1)))
+			print('column without bitmaps: counted as zero births')
+			failures = failures+1
+		except KeyError as error:
+			print('column without bitmaps: ', error)
+
+	if failures>0:
+		raise SystemExit(str(failures)+' bitmap counts differ from the pandas masks')
+	print('every bitmap count matches the pandas masks')
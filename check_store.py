@@ -0,0 +1,87 @@
+'''
+Store check
+
+Ingests a synthetic year file into a temporary columnar store (ninja_functions.ingest_year, the chunked mode of
+preprocess_birth_data.py) with the compact dtypes of birth_code_dtypes, and compares load_birth_store with the
+csv read as str (the BigData layout):
+	values 		number of births of every value of every column per month, missing data included
+	memory 		size of the loaded table, compact dtypes against dtype=str
+	dtypes 		a value that doesn't fit its dtype stops the ingest (encode_store_column)
+
+Usage:
+	python check_store.py
+
+'''
+
+import ninja_functions
+## libraries
+import numpy as np
+import pandas as pd
+import os
+import tempfile
+
+keep_columns = ['DOB_YY','DOB_MM','DPLURAL','MAGER9','PREVIS_REC','MEDUC','RF_INFTR']
+
+#################################################################################### synthetic year file
+def write_year_file(file_path, year_='2020', n_rows=50000, seed=0):
+	''' year file as downloaded from the NBR website: lower case names, blank fields for missing data,
+	MAGER9 mixes '01' and '1' (the same code), RF_INFTR is a letter code'''
+	rng = np.random.default_rng(seed)
+	def codes(values, missing):
+		column = rng.choice(np.array(values, dtype=object), n_rows)
+		column[rng.random(n_rows)<missing] = ''
+		return column
+	year = pd.DataFrame({'dob_yy': year_, 'dob_mm': rng.choice([str(month_) for month_ in range(1, 13)], n_rows),
+						'dplural': codes(['1','1','1','2','3'], 0.001),
+						'mager9': codes(['1','01','2','3','4','5','6','7','8','9'], 0.02),
+						'previs_rec': codes(['1','2','3','4','5','6','7','8','9','10','11','12'], 0.05),
+						'meduc': codes(['1','2','3','4','5','6','7','8','9'], 0.05),
+						'rf_inftr': codes(['Y','N','U'], 0.03)})
+	year.to_csv(file_path, index=False)
+
+def ingest_year_file(file_path, store_dir, year_='2020', chunksize=7000):
+	''' the chunked ingest of one year, with several chunks'''
+	store_columns = [name for name in keep_columns if name not in ['DOB_YY','DOB_MM']]
+	dtypes = {name: ninja_functions.birth_code_dtypes[name] for name in store_columns}
+	rename = {name.lower(): name for name in keep_columns}
+	ninja_functions.ingest_year(year_, file_path, rename, keep_columns, store_dir, chunksize, dtypes)
+	ninja_functions.write_store_meta(store_dir, store_columns, dtypes)
+
+def births_per_value(tab, name):
+	''' date x value number of births, values as the strings of the csv ('01' and '1' are the same code)'''
+	values = tab[name].astype(object).where(tab[name].notna(), 'missing').astype(str).str.strip()
+	values = values.str.lstrip('0').where(values.str.isdigit(), values)
+	return pd.crosstab(tab['date'].astype(str), values)
+
+
+if __name__=='__main__':
+	failures = 0
+	with tempfile.TemporaryDirectory() as work_dir:
+		file_path = os.path.join(work_dir, 'nat2020us.csv')
+		store_dir = os.path.join(work_dir, 'birth_store')
+		write_year_file(file_path)
+		ingest_year_file(file_path, store_dir)
+
+		## the reference: the year file read as str, with the date column of the BigData csv
+		csv_table = ninja_functions.add_date_column(pd.read_csv(file_path, dtype=str).rename(columns=str.upper))
+		store_table = ninja_functions.load_birth_store(store_dir)
+		for name in keep_columns[2:]:
+			same = births_per_value(csv_table, name).equals(births_per_value(store_table, name))
+			failures = failures+int(not same)
+			print(name, store_table[name].dtype, ': ', 'same' if same else 'DIFFERENT')
+
+		csv_bytes = csv_table[['date']+keep_columns[2:]].memory_usage(deep=True).sum()
+		store_bytes = store_table.memory_usage(deep=True).sum()
+		print('memory: dtype=str ', csv_bytes, ' bytes, store ', store_bytes, ' bytes (', '%.1f' % (csv_bytes/store_bytes), 'x smaller)')
+		failures = failures+int(store_bytes>=csv_bytes)
+
+	try:
+		ninja_functions.encode_store_column(pd.Series(['1', 'X'], name='MEDUC'), 'int8')
+		print('a letter in an int8 column: stored as missing')
+		failures = failures+1
+	except ValueError as error:
+		print('a letter in an int8 column: ', error)
+
+	if failures>0:
+		raise SystemExit(str(failures)+' store checks failed')
+	print('the store matches the csv')
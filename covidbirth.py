@@ -54,9 +54,13 @@ legend_font = {'size': 12, 'weight': 'normal'}
 source_dir = 'covidbirth/documentation/'
 data_dir = 'covidbirth/csv_data/'
 
-birth_metadata = pd.read_excel(source_dir+'CDC_database_codeNames.xlsx')
 ##
 census_dir = 'census_data/'
+## ACS S0101 table of every year (1Y, except the 5Y estimates of 2020)
+census_files = {'2015': 'ACSST1Y2015.S0101-Data.csv', '2016': 'ACSST1Y2016.S0101-Data.csv',
+				'2017': 'ACSST1Y2017.S0101-Data.csv', '2018': 'ACSST1Y2018.S0101-Data.csv',
+				'2019': 'ACSST1Y2019.S0101-Data.csv', '2020': 'ACSST5Y2020.S0101-Data.csv',
+				'2021': 'ACSST1Y2021.S0101-2023-06-12T202017.csv'}
 
 ### mortality
 mortality_source_dir = 'mortality/documentation/'
@@ -73,56 +77,90 @@ colores = ['forestgreen','orangered','cyan','brown','magenta','violet']
 #################################################################################### loading data chunk
 #### first count the total births per day and then per month.
 #### variable to count birth incidences: DPLURAL
-print('... loading pre-processed data, please wait (approx 10 minutes starting ', datetime.now().time(), ') ...')
+#### the columnar store written by preprocess_birth_data.py only loads the columns and years requested,
+#### set use_birth_store = False to read the legacy BigData csv instead
+use_birth_store = True
+store_dir = data_dir+'birth_store/'
+birth_columns = ['DPLURAL','MAGER9','PREVIS_REC','MEDUC','RF_INFTR']
+birth_years = ['2015','2016','2017','2018','2019','2020','2021']
+#### aggregation_mode = 'out_of_core' never loads the whole table: the preprocessed data is streamed
+#### in batches of at most memory_budget_mb, and only the monthly aggregates are kept in memory
+#### aggregation_mode = 'parallel' loads the table, and the variables are counted by n_workers processes
+#### sharing its encoded columns
+aggregation_mode = 'in_memory'
+memory_budget_mb = 2048
+## one process (in_memory counting) where fork isn't available: spawned workers would run this script again
+n_workers = ninja_functions.script_workers(os.cpu_count())
+
+#### the codebook, keyDates and census tables are read by threads while the births are loading,
+#### each input is a future: .result() waits for it
+inputs = ninja_functions.start_input_loaders({
+	'codebook': lambda: ninja_functions.get_codebook(source_dir),
+	'keyDates': lambda: pd.read_excel(source_dir+'covid_keydates.xlsx'),
+	'census': lambda: ninja_functions.load_census_population(census_dir, census_files)})
+
 tik = time.perf_counter()
-tab = pd.read_csv(data_dir+'BigData_births2015to2021.csv', dtype=str)
+if aggregation_mode=='out_of_core':
+	print('... out-of-core aggregation, memory budget: ', memory_budget_mb, ' MB ...')
+elif use_birth_store:
+	print('... loading pre-processed data from ', store_dir, ' ...')
+	tab = ninja_functions.load_birth_store(store_dir, birth_columns, birth_years)
+else:
+	print('... loading pre-processed data, please wait (approx 10 minutes starting ', datetime.now().time(), ') ...')
+	tab = pd.read_csv(data_dir+'BigData_births2015to2021.csv', dtype=str)
 tok = time.perf_counter()
 DT= (tok-tik)/60
 DT_= '%.2f' % DT
 print('loaded preprocessed data, time: ',DT_,' minutes \n')
 
 
+codebook = inputs['codebook'].result()
+birth_metadata = codebook.table
+
 ############## processing of "total births" and also total "labor events"
-keyDates = pd.read_excel(source_dir+'covid_keydates.xlsx')
+keyDates = inputs['keyDates'].result()
 
 
 ################################################################################## census data
 
-mtd15 = pd.read_csv(census_dir+'ACSST1Y2015.S0101-Column-Metadata.csv', dtype=str)
-pop15 = pd.read_csv(census_dir+'ACSST1Y2015.S0101-Data.csv', dtype=str)
-pop16 = pd.read_csv(census_dir+'ACSST1Y2016.S0101-Data.csv', dtype=str)
-pop17 = pd.read_csv(census_dir+'ACSST1Y2017.S0101-Data.csv', dtype=str)
-pop18 = pd.read_csv(census_dir+'ACSST1Y2018.S0101-Data.csv', dtype=str)
-pop19 = pd.read_csv(census_dir+'ACSST1Y2019.S0101-Data.csv', dtype=str)
-pop20 = pd.read_csv(census_dir+'ACSST5Y2020.S0101-Data.csv', dtype=str)
-pop21 = pd.read_csv(census_dir+'ACSST1Y2021.S0101-2023-06-12T202017.csv', dtype=str)
-
-
-
-tota15, population_ratio15= ninja_functions.get_pop_percentages_F15(pop15)
-tota16, population_ratio16= ninja_functions.get_pop_percentages_F15(pop16)
-tota17, population_ratio17= ninja_functions.get_pop_percentages(pop17)
-tota18, population_ratio18= ninja_functions.get_pop_percentages(pop18)
-tota19, population_ratio19= ninja_functions.get_pop_percentages(pop19)
-tota20, population_ratio20= ninja_functions.get_pop_percentages(pop20)
-tota21, population_ratio21= ninja_functions.get_pop_percentages_F21(pop21)
+#### year x age bracket population (census.brackets('Total'), census.brackets('Female')), parsed once and cached
+census = inputs['census'].result()
 
 
 ################################################################################## birth data
-
+#### every monthly series is computed in a single scan of the table:
+#### (variable, counting mode, other columns that must not be missing)
+#### adding a variable here is almost free, the table is not copied or scanned again
+birth_specs = [('DPLURAL','sum'), ('MAGER9','count'),
+				('PREVIS_REC','count',['MEDUC']), ('MEDUC','count',['PREVIS_REC']),
+				('RF_INFTR','letter')]
+tik=time.perf_counter()
+if aggregation_mode=='out_of_core':
+	if use_birth_store:
+		birth_batches = ninja_functions.iter_store_batches(store_dir, ninja_functions.spec_columns(birth_specs), birth_years, memory_budget_mb*2**20)
+	else:
+		birth_batches = ninja_functions.iter_csv_batches(data_dir+'BigData_births2015to2021.csv', ninja_functions.spec_columns(birth_specs), memory_budget_mb*2**20)
+	birth_aggregates = ninja_functions.aggregate_out_of_core(birth_batches, birth_specs)
+elif aggregation_mode=='parallel':
+	birth_aggregates = ninja_functions.aggregate_parallel(tab, birth_specs, n_workers)
+else:
+	birth_aggregates = ninja_functions.aggregate_variables(tab, birth_specs)
+tok=time.perf_counter()
+print('aggregated ', [spec[0] for spec in birth_specs], ', time: ', '%.2f' % ((tok-tik)/60), ' minutes \n')
 
 var1 = 'DPLURAL'
-### get clean data
-borntab, label =  ninja_functions.get_clean_column(source_dir,tab,var1)
-### organize it with some function
-time_series, birthseries= ninja_functions.compute_births(var1,borntab, label)
+time_series = birth_aggregates[var1]['time_series']
+birthseries = birth_aggregates[var1]['series']
 
-############ births per month
-norm_year = np.array([31,28,31,30,31,30,31,31,30,31,30,31])
-leap_year = np.array([31,29,31,30,31,30,31,31,30,31,30,31])
+############ births per 1,000 women 15 to 44 years old
+birth_rate = ninja_functions.birth_rate_series(birthseries, time_series, census)
+for year_ in census.years:
+	print(year_, ', births per 1,000 women 15-44, monthly mean: ', '%.2f' % np.nanmean(birth_rate[[t[0:4]==year_ for t in time_series]]))
 
-# days_in_month = 2015, 2016, 2017, 2018, 2019, 2020, 2021
-days_in_month = np.concatenate((norm_year, norm_year, norm_year, norm_year, norm_year, leap_year, norm_year), axis=None)
+############ births per month
+#### calendar of the series (leap years included)
+months = ninja_functions.MonthIndex(time_series)
+days_in_month = months.days_in_month()
 ##########################################################################################################
 ##########################################################################################################
 ##########################################################################################################
@@ -142,11 +180,8 @@ days_in_month = np.concatenate((norm_year, norm_year, norm_year, norm_year, norm
 # g[8] - 50 to 54
 ###########################################
 
-tik=time.perf_counter()
-### get clean data
-magetab, label =  ninja_functions.get_clean_column(source_dir,tab,'MAGER9')
 # time_series, g1, g2, g3, g4, g5, g6, g7, g8, g9 = ninja_functions.collect_MAGE(magetab,'MAGER9')
-time_series, g = ninja_functions.collect_variable(magetab,'MAGER9')
+g = birth_aggregates['MAGER9']['series']
 
 
 ##########################################################################################################
@@ -170,9 +205,7 @@ Numer of Prenatal visits recode
 12 - no data 
 '''
 
-### get clean data
-# previstab, label =  ninja_functions.get_two_column(source_dir,tab,'PREVIS_REC','MEDUC')
-previstab, labels, codes =  ninja_functions.get_two_column(source_dir,tab,'PREVIS_REC','MEDUC')
+### PREVIS_REC and MEDUC are counted on the rows where both are present (as in get_two_column)
 
 ### 	the logic of the coding scheme for all variables are consistent
 ### 	the higher the number, the greater the number of prenatal visits
@@ -183,8 +216,8 @@ previstab, labels, codes =  ninja_functions.get_two_column(source_dir,tab,'PREVI
 # time_series, n1, n2, n3, n4, n5, n6, n7, n8, n9, n10, n11 = ninja_functions.collect_prenatal_visits(previstab,'PREVIS_REC')
 # time_series, e1, e2, e3, e4, e5, e6, e7, e8, e9 = ninja_functions.collect_mothers_education(previstab,'MEDUC')
 
-time_series, n= ninja_functions.collect_variable(previstab,'PREVIS_REC')
-time_series, e= ninja_functions.collect_variable(previstab,'MEDUC')
+n = birth_aggregates['PREVIS_REC']['series']
+e = birth_aggregates['MEDUC']['series']
 
 
 '''
@@ -201,23 +234,46 @@ mother's education (from documentation):
 
 '''
 
-tik=time.perf_counter() 
 var1 = 'RF_INFTR'
-### get clean data
-fttab, label =  ninja_functions.get_clean_column(source_dir,tab,var1)
+yay_nay = birth_aggregates[var1]['series']
+
+
+############################################ derived metrics
+#### share of births, births per day, year over year change and 3 months rolling mean of every code,
+#### computed for all the rows of a variable at once (kept in model_data/series_metrics.npz)
+metrics = ninja_functions.cached_series_metrics('model_data/series_metrics.npz',
+					{'DPLURAL': birthseries, 'MAGER9': g, 'PREVIS_REC': n, 'MEDUC': e, 'RF_INFTR': yay_nay},
+					birthseries, months, window=3)
+mage_share = metrics['MAGER9']['share']
+prenatal_share = metrics['PREVIS_REC']['share']
+
 
-time_series, yay_nay = ninja_functions.collect_YayNay_variable(fttab,var1)
+############################################ key dates
+#### every key date, aligned on the months of the series, with its exposure window
+#### (the 42 weeks of the gestations under way) and the 6 months before and after it
+events = ninja_functions.EventWindows(months, keyDates['plot_date'], keyDates['event'], weeks=42, window=6)
+event_summary = events.summarize({'births': birthseries, 'births per day': metrics['DPLURAL']['per_day'],
+								'MAGER9': mage_share, 'PREVIS_REC': prenatal_share,
+								'MEDUC': metrics['MEDUC']['share'], 'RF_INFTR': metrics['RF_INFTR']['share']},
+								{var_: birth_aggregates[var_]['codes'] for var_ in ['MAGER9','PREVIS_REC','MEDUC','RF_INFTR']})
+print(event_summary[event_summary['variable'].isin(['births', 'births per day'])], '\n')
+event_summary.to_csv('model_data/event_windows.csv', index=False)
 
 
 ############################################ save variables for subsequent analysis
 
-np.save('model_data/time_series.npy', time_series, allow_pickle=True)
-np.save('model_data/birthseries.npy', birthseries, allow_pickle=False)
-np.save('model_data/days_series.npy', days_in_month, allow_pickle=False)
-np.save('model_data/mage_series.npy', g, allow_pickle=False)
-np.save('model_data/prenaseries.npy', n, allow_pickle=False)
-np.save('model_data/educ_series.npy', e, allow_pickle=False)
-np.save('model_data/fertiseries.npy', yay_nay, allow_pickle=False)
+#### one versioned time-series store (model_data/series_store/): the month index, every variable with its codes
+#### and labels, and where it comes from. math_births.py opens it with ninja_functions.SeriesStore
+series_variables = {'births': {'series': birthseries, 'label': 'births (sum of DPLURAL)'},
+					'days_in_month': {'series': days_in_month, 'label': 'days in the month'}}
+for var_ in ['MAGER9','PREVIS_REC','MEDUC','RF_INFTR']:
+	series_variables[var_] = {'series': birth_aggregates[var_]['series'], 'codes': birth_aggregates[var_]['codes'],
+							'label': codebook.label(var_), 'code_labels': codebook.code_labels(var_)}
+series_provenance = {'script': 'covidbirth.py', 'source': store_dir if use_birth_store else data_dir+'BigData_births2015to2021.csv',
+					'years': birth_years, 'specs': [list(spec[0:2])+[list(spec[2]) if len(spec)>2 else []] for spec in birth_specs],
+					'aggregation_mode': aggregation_mode}
+version = ninja_functions.write_series_store('model_data/series_store/', time_series, series_variables, series_provenance)
+print('saved time-series store, version ', version, '\n')
 
 
 ############################################ plot data
@@ -229,7 +285,7 @@ ax0=f0.add_subplot(211)
 ax1=f0.add_subplot(212)
 
 ax0.plot(time_series, birthseries)
-ax1.plot(time_series, birthseries/days_in_month)
+ax1.plot(time_series, metrics['DPLURAL']['per_day'])
 
 ax0.set_ylabel('total births')
 ax1.set_ylabel('births per day')
@@ -247,15 +303,15 @@ plt.close('all')
 f0=plt.figure(figsize=(20,20))
 ax0=f0.add_subplot(111)
 
-ax0.plot(time_series, g[0]/birthseries, label= 'under 15')
-ax0.plot(time_series, g[1]/birthseries, label= '15 to 19')
-ax0.plot(time_series, g[2]/birthseries, label= '20 to 24')
-ax0.plot(time_series, g[3]/birthseries, label= '25 to 29')
-ax0.plot(time_series, g[4]/birthseries, label= '30 to 34')
-ax0.plot(time_series, g[5]/birthseries, label= '35 to 39')
-ax0.plot(time_series, g[6]/birthseries, label= '30 to 44')
-ax0.plot(time_series, g[7]/birthseries, label= '45 to 49')
-ax0.plot(time_series, g[8]/birthseries, label= '50 to 54')
+ax0.plot(time_series, mage_share[0], label= 'under 15')
+ax0.plot(time_series, mage_share[1], label= '15 to 19')
+ax0.plot(time_series, mage_share[2], label= '20 to 24')
+ax0.plot(time_series, mage_share[3], label= '25 to 29')
+ax0.plot(time_series, mage_share[4], label= '30 to 34')
+ax0.plot(time_series, mage_share[5], label= '35 to 39')
+ax0.plot(time_series, mage_share[6], label= '30 to 44')
+ax0.plot(time_series, mage_share[7], label= '45 to 49')
+ax0.plot(time_series, mage_share[8], label= '50 to 54')
 
 ax0.set_ylabel('Mother age normalized')
 
@@ -275,10 +331,9 @@ ax0=f0.add_subplot(111)
 
 ax1 = ax0.twinx()
 
-ax0.plot(time_series, g[1]/birthseries, label='15 to 19')
-g1_ = g[1]/birthseries
+ax0.plot(time_series, mage_share[1], label='15 to 19')
 
-ax1.plot(time_series[12:83], (g1_[12:83]-g1_[0:71])/g1_[0:71],color='orangered',alpha=0.5, label='Y/y')
+ax1.plot(time_series, metrics['MAGER9']['share_yoy'][1],color='orangered',alpha=0.5, label='Y/y')
 
 # YoY change = ((Current Year Value - Previous Year Value) / Previous Year Value) * 100
 
@@ -300,41 +355,36 @@ plt.close('all')
 f0=plt.figure(figsize=(20,20))
 ax0=f0.add_subplot(111)
 
-ax0.plot(time_series, n[0]/birthseries, label= 'No visits')
-ax0.plot(time_series, n[1]/birthseries, label= '1-2')
-ax0.plot(time_series, n[2]/birthseries, label= '3-4')
-ax0.plot(time_series, n[3]/birthseries, label= '5-6')
-ax0.plot(time_series, n[4]/birthseries, label= '7-8')
-ax0.plot(time_series, n[5]/birthseries, label= '9-10')
-ax0.plot(time_series, n[6]/birthseries, label= '11-12')
-ax0.plot(time_series, n[7]/birthseries, label= '13-14')
-ax0.plot(time_series, n[8]/birthseries, label= '15-16')
-ax0.plot(time_series, n[9]/birthseries, label= '15-16')
-ax0.plot(time_series, n[10]/birthseries, label= '17-18')
-ax0.plot(time_series, n[11]/birthseries, label= '19+')
+ax0.plot(time_series, prenatal_share[0], label= 'No visits')
+ax0.plot(time_series, prenatal_share[1], label= '1-2')
+ax0.plot(time_series, prenatal_share[2], label= '3-4')
+ax0.plot(time_series, prenatal_share[3], label= '5-6')
+ax0.plot(time_series, prenatal_share[4], label= '7-8')
+ax0.plot(time_series, prenatal_share[5], label= '9-10')
+ax0.plot(time_series, prenatal_share[6], label= '11-12')
+ax0.plot(time_series, prenatal_share[7], label= '13-14')
+ax0.plot(time_series, prenatal_share[8], label= '15-16')
+ax0.plot(time_series, prenatal_share[9], label= '15-16')
+ax0.plot(time_series, prenatal_share[10], label= '17-18')
+ax0.plot(time_series, prenatal_share[11], label= '19+')
 
 start_date = datetime(2015, 1, 1)
 end_date = datetime(2023, 1, 10)
 date_list = ninja_functions.make_time_list(start_date, end_date)
 
+## key dates to plot that fall on a date of time_series, and the month of the end of their 42 weeks gestation window
 x_coord, x_label = ninja_functions.get_coordinates_keyDates(time_series,keyDates)
-# Convert dates to datetime object
-datetime_dates = np.array([datetime.strptime(date, '%Y-%m-%d') for date in x_coord])
-# Add 42 weeks to each date
-gestation = np.array([date + timedelta(weeks=42) for date in datetime_dates])
-gestation = np.array([date.replace(day=1) for date in gestation])
-# Convert new dates back to string format
-ninemonthsaftercovid = np.array([date.strftime('%Y-%m-%d') for date in gestation])
+ninemonthsaftercovid = ninja_functions.EventWindows(months, x_coord, x_label, weeks=42).gestation_labels()
 
 # min 3
 # max 6
 print('dates: \n')
 displace_1 = 3e-3
 for x in range(0,len(x_coord)):
-	ax0.plot([x_coord[x], x_coord[x]],[np.min(n[3]/birthseries)-x*displace_1, np.max(n[6]/birthseries)-x*displace_1],'--',label=x_label[x],linewidth=5, c=colores[x],alpha=0.4)
-	ax0.plot([ninemonthsaftercovid[x],ninemonthsaftercovid[x]],[np.min(n[3]/birthseries)-x*displace_1, np.max(n[6]/birthseries)-x*displace_1],'--',linewidth=5, c=colores[x],alpha=0.4)
-	ax0.plot([x_coord[x],ninemonthsaftercovid[x]],[np.max(n[6]/birthseries)-x*displace_1, np.max(n[6]/birthseries)-x*displace_1],'--',linewidth=5, c=colores[x],alpha=0.4)
-	ax0.plot([x_coord[x],ninemonthsaftercovid[x]],[np.min(n[3]/birthseries)-x*displace_1, np.min(n[3]/birthseries)-x*displace_1],'--',linewidth=5, c=colores[x],alpha=0.4)
+	ax0.plot([x_coord[x], x_coord[x]],[np.min(prenatal_share[3])-x*displace_1, np.max(prenatal_share[6])-x*displace_1],'--',label=x_label[x],linewidth=5, c=colores[x],alpha=0.4)
+	ax0.plot([ninemonthsaftercovid[x],ninemonthsaftercovid[x]],[np.min(prenatal_share[3])-x*displace_1, np.max(prenatal_share[6])-x*displace_1],'--',linewidth=5, c=colores[x],alpha=0.4)
+	ax0.plot([x_coord[x],ninemonthsaftercovid[x]],[np.max(prenatal_share[6])-x*displace_1, np.max(prenatal_share[6])-x*displace_1],'--',linewidth=5, c=colores[x],alpha=0.4)
+	ax0.plot([x_coord[x],ninemonthsaftercovid[x]],[np.min(prenatal_share[3])-x*displace_1, np.min(prenatal_share[3])-x*displace_1],'--',linewidth=5, c=colores[x],alpha=0.4)
 
 
 ax0.set_ylabel('Prenatal care normalized')
@@ -56,34 +56,20 @@ legend_font = {'size': 12, 'weight': 'normal'}
 ### plotting crutch
 colores = ['forestgreen','orangered','cyan','brown','magenta','violet']
 #
-time_series = 	np.load('model_data/time_series.npy', allow_pickle=True)
-birthseries = 	np.load('model_data/birthseries.npy', allow_pickle=False)
-days_in_month = np.load('model_data/days_series.npy', allow_pickle=False)
-g = np.load('model_data/mage_series.npy', allow_pickle=False)
-n = np.load('model_data/prenaseries.npy', allow_pickle=False)
-e = np.load('model_data/educ_series.npy', allow_pickle=False)
-yay_nay = 		np.load('model_data/fertiseries.npy', allow_pickle=False)
+## time-series store written by covidbirth.py, the series are memory-mapped
+series_store = ninja_functions.SeriesStore('model_data/series_store/')
+time_series = 	series_store.time_series()
+birthseries = 	series_store.series('births')
+days_in_month = series_store.series('days_in_month')
+g = series_store.series('MAGER9')
+n = series_store.series('PREVIS_REC')
+e = series_store.series('MEDUC')
+yay_nay = 		series_store.series('RF_INFTR')
 
 ########## normalize around a median value:
-birth_median15 = np.median(birthseries[0:12])
-birth_median16 = np.median(birthseries[12:24])
-birth_median17 = np.median(birthseries[24:36])
-birth_median18 = np.median(birthseries[36:42])
-birth_median19 = np.median(birthseries[42:60])
-birth_median20 = np.median(birthseries[60:72])
-birth_median21 = np.median(birthseries[72:84])
-
-
-######## create timeseries of birth median, use it to normalize, visualize normalized data
-pop15, t_15 = ninja_functions.make_population_series(birth_median15, '2015',time_series)
-pop16, t_16 = ninja_functions.make_population_series(birth_median16, '2016',time_series)
-pop17, t_17 = ninja_functions.make_population_series(birth_median17, '2017',time_series)
-pop18, t_18 = ninja_functions.make_population_series(birth_median18, '2018',time_series)
-pop19, t_19 = ninja_functions.make_population_series(birth_median19, '2019',time_series)
-pop20, t_20 = ninja_functions.make_population_series(birth_median20, '2020',time_series)
-pop21, t_21 = ninja_functions.make_population_series(birth_median21, '2021',time_series)
-
-median_normalization = np.concatenate((pop15, pop16, pop17, pop18, pop19, pop20, pop21), axis=None)
+######## the median of every year, repeated on its months. use it to normalize, visualize normalized data
+months = ninja_functions.MonthIndex(time_series)
+median_normalization = months.yearly(birthseries, np.median)
 
 ### normalized births series, remove the trend, only the oscillation:
 seasonal_births = birthseries-median_normalization
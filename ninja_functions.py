@@ -17,6 +17,19 @@ import numpy as np
 import matplotlib.pyplot as plt
 import pandas as pd 
 import os
+import sys
+import glob
+import json
+import pickle
+import shutil
+import hashlib
+import ast
+import zipfile
+import gzip
+import subprocess
+import multiprocessing
+from multiprocessing import shared_memory
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
 from datetime import datetime, timedelta
 
@@ -33,44 +46,134 @@ these functions are used for processing and cleaning of timeseries data
 
 '''
 
+##################################################################################
+######## codebook: CDC_database_codeNames.xlsx parsed once
+class Codebook:
+	''' code -> label (and value domain) of the CDC database variables.
+	the excel file is parsed once and kept as a binary sidecar (same name, .pkl) next to it,
+	the sidecar is used as long as the modification time of the excel file doesn't change'''
+	def __init__(self, source_dir, file_name='CDC_database_codeNames.xlsx'):
+		self.file_path = source_dir+file_name
+		self.sidecar_path = os.path.splitext(self.file_path)[0]+'.pkl'
+		self.mtime = os.stat(self.file_path).st_mtime
+		self.table = self._load_table()
+
+		self.labels = dict(zip(self.table.Code, self.table.Label))
+		## optional columns of the codebook
+		self.dtypes = {}
+		self.domains = {}
+		self.code_label_map = {}
+		for name in self.table.columns:
+			if str(name).lower()=='dtype':
+				self.dtypes = {code: str(value) for code, value in zip(self.table.Code, self.table[name]) if pd.notna(value)}
+			if str(name).lower() in ['domain', 'values']:
+				self.domains = {code: parse_code_domain(value) for code, value in zip(self.table.Code, self.table[name]) if pd.notna(value)}
+			if str(name).lower() in ['code labels', 'code_labels']:
+				self.code_label_map = {code: parse_code_labels(value) for code, value in zip(self.table.Code, self.table[name]) if pd.notna(value)}
+
+	def _load_table(self):
+		if os.path.exists(self.sidecar_path):
+			## a truncated sidecar, or one written by other versions of pandas, is read again from the xlsx and rewritten
+			try:
+				with open(self.sidecar_path, 'rb') as f:
+					cached = pickle.load(f)
+				if cached['mtime']==self.mtime:
+					return cached['table']
+			except (pickle.UnpicklingError, EOFError, AttributeError, ImportError, KeyError, TypeError):
+				print('could not read codebook sidecar ', self.sidecar_path, ', reading ', self.file_path)
+		table = pd.read_excel(self.file_path)
+		try:
+			## written next to it and renamed: a reader never sees a partial sidecar
+			with open(self.sidecar_path+'.tmp', 'wb') as f:
+				pickle.dump({'mtime': self.mtime, 'table': table}, f, protocol=pickle.HIGHEST_PROTOCOL)
+			os.replace(self.sidecar_path+'.tmp', self.sidecar_path)
+		except OSError:
+			print('could not write codebook sidecar ', self.sidecar_path)
+		return table
+
+	def label(self, code):
+		return self.labels[code]
+
+	def domain(self, code):
+		''' list of the values of code, None when the codebook doesn't list them'''
+		return self.domains.get(code)
+
+	def dtype(self, code):
+		return self.dtypes.get(code)
+
+	def code_labels(self, code):
+		''' {value: label} of the values of code, None when the codebook doesn't list them'''
+		return self.code_label_map.get(code)
+
+	def __contains__(self, code):
+		return code in self.labels
+
+def parse_code_domain(value):
+	''' '1-9' or '1,2,3' or 'Y,N,U' to a list of values'''
+	domain = []
+	for item in str(value).replace(';', ',').split(','):
+		item = item.strip()
+		if '-' in item and item.replace('-', '').isdigit():
+			start_, end_ = item.split('-')
+			domain = domain+list(range(int(start_), int(end_)+1))
+		elif item.isdigit():
+			domain.append(int(item))
+		elif item!='':
+			domain.append(item)
+	return domain
+
+def parse_code_labels(value):
+	''' '1=Under 15; 2=15 to 19' to {1: 'Under 15', 2: '15 to 19'}'''
+	labels = {}
+	for item in str(value).split(';'):
+		if '=' in item:
+			code, label = item.split('=', 1)
+			code = code.strip()
+			labels[int(code) if code.isdigit() else code] = label.strip()
+	return labels
+
+_codebooks = {}
+def get_codebook(source_dir):
+	''' the Codebook of source_dir, parsed once per session (and again if the excel file changes)'''
+	codebook = _codebooks.get(source_dir)
+	file_path = source_dir+'CDC_database_codeNames.xlsx'
+	if codebook is None or codebook.mtime!=os.stat(file_path).st_mtime:
+		codebook = Codebook(source_dir)
+		_codebooks[source_dir] = codebook
+	return codebook
+
 def get_coordinates_keyDates(time_series,keyDates):
-	x_coord = np.array([])
-	x_label = np.array([])
-	for x in range(0, len(keyDates)):
-		if keyDates['plot'][x]=='y':
-			# print(x)
-			for i in range(0,len(time_series)):
-			# i=71
-				xdate = time_series[i]
-				ydate = keyDates['plot_date'][x].date()
-
-				# print(xdate,ydate.strftime('%Y-%m-%d'))
-				# print(xdate==ydate.strftime('%Y-%m-%d'))
-				if xdate==ydate.strftime('%Y-%m-%d'):
-					print(time_series[i],xdate,keyDates['event'][x])
-					x_coord = np.append(x_coord, time_series[i])
-					x_label = np.append(x_label, keyDates['event'][x])
+	''' dates of time_series (and event names) of the keyDates to plot, when they fall on a date of time_series'''
+	plotted = (keyDates['plot']=='y').to_numpy()
+	dates = pd.to_datetime(keyDates['plot_date']).dt.strftime('%Y-%m-%d').to_numpy(dtype=object)[plotted]
+	events = keyDates['event'].to_numpy(dtype=object)[plotted]
+	found = np.isin(dates, np.asarray(time_series, dtype=object))
+	for xdate, event in zip(dates[found], events[found]):
+		print(xdate,xdate,event)
+	x_coord = np.array(list(dates[found]), dtype=str)
+	x_label = np.array(list(events[found]), dtype=str)
 	return x_coord, x_label
 
-def get_clean_column(source_dir,bigData,var1):
-	tab = bigData[['date', var1]].copy()
-	tab = tab.dropna(subset=[var1,'date'])
-	dict1 = pd.read_excel(source_dir+'CDC_database_codeNames.xlsx')
-	cod_of_int = dict1.Code[dict1.Code==var1]
-	var_of_int = dict1.Label[dict1.Code==var1]
-	# print(var_of_int.values[0])
-
-	return tab, var_of_int.values[0]
-
-def get_two_column(source_dir,bigData,var1,var2):
-	tab = bigData[['date', var1,var2]].copy()
-	tab = tab.dropna(subset=[var1,var2,'date'])
-	dict1 = pd.read_excel(source_dir+'CDC_database_codeNames.xlsx')
-	cod_of_int = dict1.Code[dict1.Code==var1]
-	var_of_int1 = dict1.Label[dict1.Code==var1]
-	var_of_int2 = dict1.Label[dict1.Code==var1]
-	# print(var_of_int.values[0])
-	df = pd.DataFrame({var1:var_of_int1.values[0],var2:var_of_int2.values[0]})
+def get_clean_column(source_dir,bigData,var1,view=False):
+	## view=True: no copy, a ColumnSelection (column references + null mask) for the counting functions
+	if view:
+		tab = ColumnSelection(bigData, ['date', var1])
+	else:
+		tab = bigData[['date', var1]].copy()
+		tab = tab.dropna(subset=[var1,'date'])
+	codebook = get_codebook(source_dir)
+	# print(codebook.label(var1))
+
+	return tab, codebook.label(var1)
+
+def get_two_column(source_dir,bigData,var1,var2,view=False):
+	if view:
+		tab = ColumnSelection(bigData, ['date', var1, var2])
+	else:
+		tab = bigData[['date', var1,var2]].copy()
+		tab = tab.dropna(subset=[var1,var2,'date'])
+	codebook = get_codebook(source_dir)
+	df = pd.DataFrame({var1:[codebook.label(var1)],var2:[codebook.label(var2)]})
 	return tab, df
 
 def make_time_list(start_date, end_date):
@@ -91,6 +194,976 @@ def make_time_list(start_date, end_date):
 	return date_list
 
 
+'''
+
+calendar
+the months of a monthly series as datetime64[M]: years, days per month and per-year statistics
+are numpy operations, correct for any range of years (leap years included).
+key dates are aligned on these months, with their exposure and gestation windows (EventWindows).
+'''
+class MonthIndex:
+	''' months of time_series (YYYY-MM-01 strings, datetimes or datetime64)'''
+	def __init__(self, time_series):
+		self.time_series = np.asarray(time_series)
+		self.months = pd.to_datetime(self.time_series.ravel()).values.astype('datetime64[M]')
+		self.year = self.months.astype('datetime64[Y]').astype(int)+1970
+		self.month = self.months.astype(int)%12+1
+		## years[year_index] is the year of every month
+		self.years, self.year_index = np.unique(self.year, return_inverse=True)
+
+	def __len__(self):
+		return len(self.months)
+
+	def days_in_month(self):
+		return ((self.months+1).astype('datetime64[D]')-self.months.astype('datetime64[D]')).astype(int)
+
+	def year_mask(self, year_):
+		return self.year==int(year_)
+
+	def reduce(self, values, function=np.median):
+		''' function of the months of every year, along the last axis of values: (..., months) -> (..., years)'''
+		values = np.asarray(values, dtype=float)
+		return np.stack([function(values[..., self.year_index==n_year], axis=-1) for n_year in range(len(self.years))], axis=-1)
+
+	def broadcast(self, per_year):
+		''' (..., years) -> (..., months), the value of its year for every month'''
+		return np.asarray(per_year)[..., self.year_index]
+
+	def yearly(self, values, function=np.median):
+		''' per-year statistic of values, repeated on the months of the year'''
+		return self.broadcast(self.reduce(values, function))
+
+	def align(self, dates):
+		''' position of the month of every date in the index, -1 when the month is not in it'''
+		months = pd.to_datetime(np.asarray(dates).ravel()).values.astype('datetime64[M]')
+		position = np.full(len(months), -1)
+		if len(self.months)==0:
+			return position
+		order = np.argsort(self.months, kind='stable')
+		sorted_months = self.months[order]
+		found = np.minimum(np.searchsorted(sorted_months, months), len(sorted_months)-1)
+		matched = sorted_months[found]==months
+		position[matched] = order[found[matched]]
+		return position
+
+	def strings(self):
+		''' YYYY-MM-01 labels, the format of time_series'''
+		return np.datetime_as_string(self.months.astype('datetime64[D]')).astype(object)
+
+
+class EventWindows:
+	''' key dates aligned on the months of a MonthIndex, with three windows per event (events x months masks):
+	pre 		the window months before the month of the event
+	exposure 	from the event to the end of the gestations under way (event + weeks)
+	post 		the window months from the end of that gestation: births conceived after the event'''
+	def __init__(self, months, dates, labels, weeks=42, window=6):
+		self.months = months
+		self.labels = np.asarray(labels, dtype=object)
+		days = pd.to_datetime(np.asarray(dates).ravel()).values.astype('datetime64[D]')
+		self.event_month = days.astype('datetime64[M]')
+		self.gestation_month = (days+np.timedelta64(7*weeks, 'D')).astype('datetime64[M]')
+		## position in the series, -1 outside of it
+		self.event_index = months.align(self.event_month)
+		self.gestation_index = months.align(self.gestation_month)
+
+		since_event = (months.months[np.newaxis, :]-self.event_month[:, np.newaxis]).astype(int)
+		since_gestation = (months.months[np.newaxis, :]-self.gestation_month[:, np.newaxis]).astype(int)
+		self.windows = {'pre': (since_event<0) & (since_event>=-window),
+						'exposure': (since_event>=0) & (since_gestation<0),
+						'post': (since_gestation>=0) & (since_gestation<window)}
+
+	def __len__(self):
+		return len(self.labels)
+
+	def event_labels(self):
+		''' YYYY-MM-01 month of every event, the format of time_series'''
+		return np.datetime_as_string(self.event_month.astype('datetime64[D]')).astype(object)
+
+	def gestation_labels(self):
+		''' YYYY-MM-01 month of the end of the gestation window of every event'''
+		return np.datetime_as_string(self.gestation_month.astype('datetime64[D]')).astype(object)
+
+	def summarize(self, series, codes=None):
+		''' mean of every row of every series in the windows of every event, in one matrix product.
+		series: {name: 1-d series, or codes x months matrix}, codes: {name: code of every row} (row number by default).
+		returns a table: event, variable, code, pre, exposure, post, change (post-pre), change_percent'''
+		codes = codes or {}
+		rows = []
+		row_labels = []
+		for name, values in series.items():
+			values = np.asarray(values, dtype=float)
+			if values.ndim==1:
+				row_labels = row_labels+[(name, '')]
+			else:
+				row_codes = codes.get(name, np.arange(len(values)))
+				row_labels = row_labels+[(name, code) for code in row_codes]
+			rows.append(np.atleast_2d(values))
+		matrix = np.vstack(rows)
+
+		table = pd.DataFrame({'event': np.repeat(self.labels, len(row_labels)),
+							'variable': [name for name, code in row_labels]*len(self),
+							'code': [code for name, code in row_labels]*len(self)})
+		with np.errstate(invalid='ignore', divide='ignore'):
+			for window, mask in self.windows.items():
+				## rows x events, NaN for a window outside of the series
+				means = (matrix @ mask.T)/np.sum(mask, axis=1)
+				table[window] = means.T.ravel()
+			table['change'] = table['post']-table['pre']
+			table['change_percent'] = 100*table['change']/table['pre']
+		return table
+
+
+'''
+
+derived metrics
+share of births, births per day, year over year change and rolling means of every row of a
+codes x months matrix (or of a 1-d series) at once, as broadcast numpy operations on the last axis.
+'''
+## part of the checksum of the metrics cache: increase it when the metrics change, the cached ones are computed again
+series_metrics_format = 1
+
+def year_over_year(series, months):
+	''' relative change from the same month of the previous year, NaN when that month is not in the series'''
+	series = np.asarray(series, dtype=float)
+	previous = months.align(months.months-12)
+	last_year = np.where(previous>=0, series[..., previous], np.nan)
+	with np.errstate(invalid='ignore', divide='ignore'):
+		return (series-last_year)/last_year
+
+def rolling_mean(series, window=3):
+	''' mean of the last window months, NaN for the first window-1 months'''
+	series = np.asarray(series, dtype=float)
+	cumulative = np.cumsum(series, axis=-1)
+	total = cumulative.copy()
+	total[..., window:] = total[..., window:]-cumulative[..., :-window]
+	result = total/window
+	result[..., :window-1] = np.nan
+	return result
+
+def series_metrics(series, birthseries, months, window=3):
+	''' series: {name: 1-d series or codes x months matrix}, on the months of birthseries.
+	returns {name: {metric: array of the shape of the series}}'''
+	birthseries = np.asarray(birthseries, dtype=float)
+	days = months.days_in_month()
+	metrics = {}
+	for name, values in series.items():
+		values = np.asarray(values, dtype=float)
+		share = values/birthseries
+		metrics[name] = {'share': share, 'per_day': values/days,
+						'yoy': year_over_year(values, months), 'share_yoy': year_over_year(share, months),
+						'rolling': rolling_mean(values, window), 'share_rolling': rolling_mean(share, window)}
+	return metrics
+
+def cached_series_metrics(cache_file, series, birthseries, months, window=3):
+	''' series_metrics, kept in cache_file (npz) with a checksum of its inputs and of series_metrics_format:
+	computed again when they change'''
+	checksum = hashlib.sha1(('format '+str(series_metrics_format)).encode())
+	for name in sorted(series):
+		checksum.update(name.encode())
+		checksum.update(np.ascontiguousarray(series[name], dtype=float).tobytes())
+	checksum.update(np.ascontiguousarray(birthseries, dtype=float).tobytes())
+	checksum.update(months.months.astype(np.int64).tobytes())
+	checksum.update(str(window).encode())
+	checksum = checksum.hexdigest()
+
+	if os.path.exists(cache_file):
+		with np.load(cache_file) as cached:
+			if str(cached['_checksum'])==checksum:
+				metrics = {}
+				for key in cached.files:
+					if key!='_checksum':
+						name, metric = key.rsplit('/', 1)
+						metrics.setdefault(name, {})[metric] = cached[key]
+				return metrics
+	metrics = series_metrics(series, birthseries, months, window)
+	arrays = {name+'/'+metric: values for name in metrics for metric, values in metrics[name].items()}
+	np.savez(cache_file, _checksum=np.array(checksum), **arrays)
+	return metrics
+
+
+'''
+
+time-series store
+the monthly series handed from covidbirth.py to math_births.py. every write is a new version directory
+(series_dir/v0001/...) with the month index (datetime64[M]), one .npy file per variable and series_meta.json
+(codes, labels, provenance). current.json points to the last complete version, the arrays are memory-mapped on load.
+'''
+series_store_format = 1
+
+def list_series_versions(series_dir):
+	if not os.path.isdir(series_dir):
+		return []
+	return sorted([int(name[1:]) for name in os.listdir(series_dir) if name.startswith('v') and name[1:].isdigit()])
+
+def series_version_dir(series_dir, version):
+	return os.path.join(series_dir, 'v'+str(version).zfill(4))
+
+def write_series_store(series_dir, time_series, variables, provenance=None, keep=3):
+	''' write a new version of the store and make it current, only the last keep versions are kept.
+	variables: {name: {'series': 1-d series or codes x months matrix, 'codes': codes of the rows (None for a 1-d series),
+				'label': description, 'code_labels': {code: label}}}
+	when the content is the one of the current version, nothing is written and current.json is left as it is.
+	returns the version number'''
+	months = MonthIndex(time_series).months
+	arrays = {}
+	meta = {'format': series_store_format, 'provenance': provenance or {}, 'variables': {}}
+	for name, variable in variables.items():
+		series = np.asarray(variable['series'], dtype=float)
+		arrays[name] = series
+		codes = variable.get('codes')
+		code_labels = variable.get('code_labels') or {}
+		meta['variables'][name] = {'file': name+'.npy', 'shape': list(series.shape),
+									'codes': None if codes is None else np.asarray(codes).tolist(),
+									'label': variable.get('label', name),
+									'code_labels': {str(code): str(label) for code, label in code_labels.items()}}
+	## checksum of the content only (not of the version or the date), compared with the current version
+	checksum = hashlib.sha1(json.dumps(meta, sort_keys=True).encode())
+	checksum.update(months.astype('int64').tobytes())
+	for name in sorted(arrays):
+		checksum.update(name.encode())
+		checksum.update(np.ascontiguousarray(arrays[name]).tobytes())
+	meta['checksum'] = checksum.hexdigest()
+
+	current_file = os.path.join(series_dir, 'current.json')
+	if os.path.exists(current_file):
+		with open(current_file) as f:
+			current_version = json.load(f)['version']
+		current_meta_file = os.path.join(series_version_dir(series_dir, current_version), 'series_meta.json')
+		if os.path.exists(current_meta_file):
+			with open(current_meta_file) as f:
+				if json.load(f).get('checksum')==meta['checksum']:
+					return current_version
+
+	versions = list_series_versions(series_dir)
+	version = versions[-1]+1 if len(versions)>0 else 1
+	version_dir = series_version_dir(series_dir, version)
+	os.makedirs(version_dir)
+	np.save(os.path.join(version_dir, 'index.npy'), months)
+	for name, series in arrays.items():
+		np.save(os.path.join(version_dir, name+'.npy'), series)
+	meta['version'] = version
+	meta['created'] = datetime.now().isoformat(timespec='seconds')
+	with open(os.path.join(version_dir, 'series_meta.json'), 'w') as f:
+		json.dump(meta, f, indent=1)
+
+	## readers switch to the new version only once it is complete
+	with open(current_file+'.tmp', 'w') as f:
+		json.dump({'version': version}, f)
+	os.replace(current_file+'.tmp', current_file)
+	for old_version in versions[:max(0, len(versions)+1-keep)]:
+		shutil.rmtree(series_version_dir(series_dir, old_version))
+	return version
+
+class SeriesStore:
+	''' read side of the time-series store: the current version (or a given one), memory-mapped'''
+	def __init__(self, series_dir, version=None):
+		if version is None:
+			with open(os.path.join(series_dir, 'current.json')) as f:
+				version = json.load(f)['version']
+		self.version_dir = series_version_dir(series_dir, version)
+		with open(os.path.join(self.version_dir, 'series_meta.json')) as f:
+			self.meta = json.load(f)
+		if self.meta['format']!=series_store_format:
+			raise ValueError('unknown time-series store format: '+str(self.meta['format']))
+		self.version = self.meta['version']
+		self.provenance = self.meta['provenance']
+		self.variables = self.meta['variables']
+		self.months = MonthIndex(np.load(os.path.join(self.version_dir, 'index.npy'), mmap_mode='r'))
+
+	def __contains__(self, name):
+		return name in self.variables
+
+	def time_series(self):
+		''' YYYY-MM-01 strings, the time_series of the pipeline'''
+		return self.months.strings()
+
+	def series(self, name):
+		return np.load(os.path.join(self.version_dir, self.variables[name]['file']), mmap_mode='r')
+
+	def codes(self, name):
+		codes = self.variables[name]['codes']
+		return None if codes is None else np.array(codes)
+
+	def label(self, name):
+		return self.variables[name]['label']
+
+	def code_labels(self, name):
+		return self.variables[name]['code_labels']
+
+
+'''
+
+ingest functions
+'''
+def resolve_year_file(data_dir, file_name):
+	''' name of the year file found in data_dir: the csv itself, or the .zip/.gz archive it came in'''
+	root_name = file_name[:-4] if file_name.endswith('.csv') else file_name
+	candidates = [file_name, file_name+'.zip', file_name+'.gz', root_name+'.zip', root_name+'csv.zip', root_name+'.csv.gz']
+	for candidate in candidates:
+		if os.path.exists(data_dir+candidate):
+			return candidate
+	raise FileNotFoundError('none of '+str(candidates)+' in '+data_dir)
+
+def open_year_file(file_path):
+	''' binary file object of a year file. zip and gzip archives are decompressed on the fly while reading,
+	nothing is extracted to disk'''
+	if file_path.lower().endswith('.zip'):
+		archive = zipfile.ZipFile(file_path)
+		members = [name for name in archive.namelist() if name.lower().endswith('.csv')]
+		if len(members)==0:
+			raise ValueError('no csv file in '+file_path)
+		return archive.open(members[0])
+	if file_path.lower().endswith('.gz'):
+		return gzip.open(file_path, 'rb')
+	return open(file_path, 'rb')
+
+def read_year_header(file_path):
+	''' column names of a year file, only the header line is parsed'''
+	with open_year_file(file_path) as f:
+		return list(pd.read_csv(f, nrows=0).columns)
+
+def build_schema_registry(data_dir, year_files, aliases=None, renames=None):
+	''' header-only schema of every year file: {year: {'file':..., 'columns': {raw_name: canonical_name}}}
+	canonical names are upper-cased raw names, unless they are found in
+	aliases 	{alias: canonical}, applied to every year
+	renames 	{year: {raw_name: canonical}}, applied to that year only (e.g. the _down style fields)'''
+	aliases = {k.upper(): v.upper() for k,v in (aliases or {}).items()}
+	registry = {}
+	for year_ in year_files:
+		rename = {k.upper(): v.upper() for k,v in (renames or {}).get(year_, {}).items()}
+		columns = {}
+		for name in read_year_header(data_dir+year_files[year_]):
+			canonical = name.upper()
+			canonical = rename.get(canonical, aliases.get(canonical, canonical))
+			columns[name] = canonical
+		registry[year_] = {'file': year_files[year_], 'columns': columns}
+	return registry
+
+def schema_common_names(registry):
+	''' canonical names present in every year (what common_names used to be)'''
+	common_names = None
+	for year_ in registry:
+		names = set(registry[year_]['columns'].values())
+		common_names = names if common_names is None else common_names.intersection(names)
+	return sorted(common_names)
+
+def schema_union(registry):
+	''' mapped union: {canonical_name: [years where it is present]}'''
+	union = {}
+	for year_ in registry:
+		for canonical in registry[year_]['columns'].values():
+			union.setdefault(canonical, []).append(year_)
+	return dict(sorted(union.items()))
+
+def save_schema_registry(registry, file_path):
+	with open(file_path, 'w') as f:
+		json.dump(registry, f, indent=1)
+
+def load_schema_registry(file_path):
+	with open(file_path) as f:
+		return json.load(f)
+
+def stream_year_file(file_path, columns, chunksize=500000, rename=None):
+	''' read one year of natality data in chunks of chunksize rows, keeping only columns.
+	the file can be a csv or the .zip/.gz archive it was downloaded in (see open_year_file).
+	rename maps raw names to canonical names (see build_schema_registry), by default names are upper-cased.
+	columns missing from a year come out as NaN'''
+	if rename is None:
+		rename = {name: name.upper() for name in read_year_header(file_path)}
+	wanted = set(columns)
+	with open_year_file(file_path) as f:
+		reader = pd.read_csv(f, dtype=str, chunksize=chunksize,
+							usecols=lambda name: rename.get(name) in wanted)
+		for chunk in reader:
+			chunk = chunk.rename(columns=rename)
+			yield chunk.reindex(columns=columns)
+
+def add_date_column(chunk):
+	''' date column as YYYY-MM-01 strings, same format as the legacy BigData csv'''
+	chunk['date'] = chunk['DOB_YY'].str.strip()+'-'+chunk['DOB_MM'].str.strip().str.zfill(2)+'-01'
+	return chunk
+
+
+'''
+
+columnar store
+one directory per month: store_dir/DOB_YY=2015/DOB_MM=01/COLUMN.npy
+every column is a plain .npy file, so it can be memory-mapped on load.
+the date is not stored, it is given by the partition.
+'''
+def partition_dir(store_dir, year_, month_):
+	return os.path.join(store_dir, 'DOB_YY='+str(year_), 'DOB_MM='+str(month_).zfill(2))
+
+def list_partitions(store_dir, years=None):
+	''' sorted list of (year, month) strings found in the store'''
+	partitions = []
+	if not os.path.isdir(store_dir):
+		return partitions
+	for year_dir in sorted(os.listdir(store_dir)):
+		if not year_dir.startswith('DOB_YY='):
+			continue
+		year_ = year_dir.split('=')[1]
+		if years is not None and year_ not in [str(y) for y in years]:
+			continue
+		for month_dir in sorted(os.listdir(os.path.join(store_dir, year_dir))):
+			if month_dir.startswith('DOB_MM='):
+				partitions.append((year_, month_dir.split('=')[1]))
+	return partitions
+
+## compact dtypes of the CDC code columns in the store
+## 	int8/int16 	numeric codes, -1 for missing data
+## 	char 		single letter codes (Y/N/U...), stored as their ascii value, 0 for missing data
+## 	str 		anything else, fixed width strings, '' for missing data
+## a dtype column in CDC_database_codeNames.xlsx takes precedence over this table (see get_code_schema)
+birth_code_dtypes = {'DOB_YY':'int16', 'DOB_MM':'int8', 'DPLURAL':'int8', 'MAGER9':'int8',
+					'PREVIS_REC':'int8', 'MEDUC':'int8', 'RF_INFTR':'char'}
+
+def get_code_schema(source_dir, columns):
+	''' dtype of every column, driven by the codebook: columns listed in CDC_database_codeNames.xlsx
+	use its dtype column when there is one, else birth_code_dtypes. anything else is kept as str'''
+	codebook = get_codebook(source_dir)
+	schema = {}
+	for name in columns:
+		if codebook.dtype(name) is not None:
+			schema[name] = codebook.dtype(name)
+		elif name in codebook and name in birth_code_dtypes:
+			schema[name] = birth_code_dtypes[name]
+		else:
+			schema[name] = 'str'
+	return schema
+
+def encode_store_column(values, dtype='str'):
+	''' string column to a compact, fixed width array (memory-mappable)'''
+	if dtype=='str':
+		return values.fillna('').to_numpy(dtype=str)
+	if dtype=='char':
+		letters = values.fillna('').str.strip()
+		if letters.str.len().max()>1:
+			raise ValueError('char dtype needs single letter codes: '+str(values.name))
+		return letters.to_numpy(dtype='U1').view(np.uint32).astype(np.uint8)
+	numbers = pd.to_numeric(values, errors='coerce')
+	## blank fields are missing data, any other value that is not a number would be lost in the store
+	lost = numbers.isna() & values.notna() & (values.astype(str).str.strip()!='')
+	if lost.any():
+		raise ValueError(str(values.name)+' has values that are not numbers, e.g. '+repr(values[lost].iloc[0])+': use dtype str or char')
+	info = np.iinfo(dtype)
+	if numbers.max()>info.max or numbers.min()<0:
+		raise ValueError(str(values.name)+' does not fit in '+dtype)
+	return numbers.fillna(-1).to_numpy().astype(dtype)
+
+def decode_store_column(values, dtype='str'):
+	''' inverse of encode_store_column, without going back to python strings:
+	numeric codes become nullable integers and letter codes a categorical, missing data is NA'''
+	if dtype=='str':
+		values = np.asarray(values).astype(object)
+		values[values==''] = np.nan
+		return values
+	if dtype=='char':
+		present = np.flatnonzero(np.bincount(values, minlength=256)[1:])+1
+		lookup = np.full(256, -1, dtype=np.int16)
+		lookup[present] = np.arange(len(present))
+		return pd.Categorical.from_codes(lookup[values], categories=[chr(c) for c in present])
+	values = np.asarray(values)
+	return pd.arrays.IntegerArray(values, values==-1)
+
+def write_store_chunk(store_dir, chunk, columns, part_id, dtypes=None):
+	''' split a chunk (with date column) by month and write it as part files of each partition'''
+	dtypes = dtypes or {}
+	for date_, part in chunk.dropna(subset=['date']).groupby('date', sort=False):
+		part_dir = os.path.join(partition_dir(store_dir, date_[0:4], date_[5:7]), '_parts', '%05d' % part_id)
+		os.makedirs(part_dir, exist_ok=True)
+		for name in columns:
+			np.save(os.path.join(part_dir, name+'.npy'), encode_store_column(part[name], dtypes.get(name, 'str')), allow_pickle=False)
+
+def compact_store_year(store_dir, year_, columns):
+	''' concatenate the part files of every month of year_ into a single file per column'''
+	for year_, month_ in list_partitions(store_dir, [year_]):
+		part_root = os.path.join(partition_dir(store_dir, year_, month_), '_parts')
+		if not os.path.isdir(part_root):
+			continue
+		parts = sorted(os.listdir(part_root))
+		for name in columns:
+			values = np.concatenate([np.load(os.path.join(part_root, part, name+'.npy')) for part in parts])
+			np.save(os.path.join(partition_dir(store_dir, year_, month_), name+'.npy'), values, allow_pickle=False)
+		shutil.rmtree(part_root)
+
+def ingest_year(year_, file_path, rename, keep_columns, store_dir, chunksize=500000, dtypes=None, count_columns=None):
+	''' stream one year file into its partitions of the store, returns its DOB_YY x DOB_MM frequency table.
+	in the same pass, the values of count_columns are counted per month (see write_value_counts).
+	runs on its own, so several years can be ingested by parallel worker processes'''
+	tic = time.perf_counter()
+	store_columns = [name for name in keep_columns if name not in ['DOB_YY','DOB_MM']]
+	count_columns = list(count_columns or [])
+	read_columns = keep_columns+[name for name in count_columns if name not in keep_columns]
+	## same number of cells per chunk as the projected read, so memory stays bounded when counting every column
+	chunksize = max(10000, chunksize*len(keep_columns)//len(read_columns))
+	clear_store_year(store_dir, year_)
+	frequency_table = None
+	## running total of every counted column: {name: (values, values x 12 months counts)}, reduced after every chunk
+	value_counts = {}
+	part_id = 0
+	for chunk in stream_year_file(file_path, read_columns, chunksize, rename):
+		chunk = add_date_column(chunk)
+		## a worker only writes the partitions of its own year
+		chunk = chunk[chunk['date'].str[0:4]==str(year_)]
+		counts = pd.crosstab(chunk['DOB_YY'], chunk['DOB_MM'], dropna=False)
+		if frequency_table is None:
+			frequency_table = counts
+		else:
+			frequency_table = frequency_table.add(counts, fill_value=0)
+		## month of every row (0 to 11, -1 when missing) once per chunk, every column is then one factorize and one bincount
+		date_index, dates = pd.factorize(chunk['date'])
+		month_index = np.append(np.array([int(date_[5:7])-1 for date_ in dates], dtype=np.int64), -1)[date_index]
+		for name in count_columns:
+			value_counts[name] = count_chunk_values(chunk[name], month_index, value_counts.get(name))
+		write_store_chunk(store_dir, chunk, store_columns, part_id, dtypes)
+		part_id = part_id+1
+	compact_store_year(store_dir, year_, store_columns)
+	if len(value_counts)>0:
+		months_ = [str(year_)+'-'+str(month_).zfill(2)+'-01' for month_ in range(1,13)]
+		write_value_counts(store_dir, {name: pd.DataFrame(counts, index=values, columns=months_) for name, (values, counts) in value_counts.items()})
+	toc = time.perf_counter()
+	DT= (toc-tic)/60
+	DT_= '%.2f' % DT
+	print('ingested '+str(year_)+', time: ',DT_,' minutes')
+	return frequency_table
+
+def _ingest_year_job(job):
+	return ingest_year(*job)
+
+def ingest_years(jobs, n_workers=1):
+	''' run ingest_year for every job (tuple of its arguments), on n_workers processes.
+	returns the merged frequency table of all years'''
+	if n_workers<=1:
+		tables = [_ingest_year_job(job) for job in jobs]
+	else:
+		with ProcessPoolExecutor(max_workers=n_workers, mp_context=worker_context()) as pool:
+			tables = list(pool.map(_ingest_year_job, jobs))
+	tables = [table for table in tables if table is not None]
+	frequency_table = pd.concat(tables).groupby(level=0).sum().sort_index(axis=1)
+	return frequency_table.fillna(0).astype(int)
+
+def export_store_csv(store_dir, file_path, years=None):
+	''' write the store as a single csv file (legacy BigData layout), one year at a time'''
+	if os.path.exists(file_path):
+		os.remove(file_path)
+	columns = ['DOB_YY','DOB_MM']+load_store_meta(store_dir)['columns']
+	write_header = True
+	for year_ in sorted(set([year_ for year_, month_ in list_partitions(store_dir, years)])):
+		tab = load_birth_store(store_dir, columns, [year_])
+		tab.to_csv(file_path, mode='a', header=write_header, index=False)
+		write_header = False
+
+def clear_store_year(store_dir, year_):
+	year_dir = os.path.join(store_dir, 'DOB_YY='+str(year_))
+	if os.path.isdir(year_dir):
+		shutil.rmtree(year_dir)
+
+def write_store_meta(store_dir, columns, dtypes=None):
+	''' record the stored columns, their dtype and number of rows of every partition'''
+	dtypes = dtypes or {}
+	partitions = {}
+	for year_, month_ in list_partitions(store_dir):
+		values = np.load(os.path.join(partition_dir(store_dir, year_, month_), columns[0]+'.npy'), mmap_mode='r')
+		partitions[year_+'-'+month_] = int(len(values))
+	meta = {'columns': list(columns), 'dtypes': {name: dtypes.get(name, 'str') for name in columns},
+			'partitions': partitions}
+	with open(os.path.join(store_dir, 'store_meta.json'), 'w') as f:
+		json.dump(meta, f, indent=1)
+	return meta
+
+def load_store_meta(store_dir):
+	with open(os.path.join(store_dir, 'store_meta.json')) as f:
+		return json.load(f)
+
+def frequency_table_from_store(meta):
+	''' DOB_YY x DOB_MM number of births, from the row counts of the partitions'''
+	counts = pd.Series(meta['partitions'])
+	years_ = counts.index.str[0:4].astype(int)
+	months_ = counts.index.str[5:7].astype(int)
+	frequency_table = pd.crosstab(years_, months_, values=counts.values, aggfunc='sum').fillna(0).astype(int)
+	frequency_table.index.name = 'DOB_YY'
+	frequency_table.columns.name = 'DOB_MM'
+	return frequency_table
+
+def load_birth_store(store_dir, columns=None, years=None):
+	''' load the preprocessed births: only the requested columns (all by default) and years (all by default).
+	returns the same layout as the BigData csv: a date column (YYYY-MM-01) plus the variables, NA for missing data.
+	columns keep their compact dtype (see decode_store_column), the date is a categorical'''
+	meta = load_store_meta(store_dir)
+	pieces = [(year_, month_, 0, meta['partitions'][year_+'-'+month_]) for year_, month_ in list_partitions(store_dir, years)]
+	return store_table(store_dir, meta, columns, pieces)
+
+def store_table(store_dir, meta, columns, pieces):
+	''' table of the rows start:stop of every (year, month, start, stop) piece of the store.
+	only these rows are read from the memory-mapped columns'''
+	if columns is None:
+		columns = meta['columns']
+	columns = [name for name in columns if name!='date']
+	dtypes = meta.get('dtypes', {})
+	n_rows = np.array([stop-start for year_, month_, start, stop in pieces], dtype=int)
+	months = list(dict.fromkeys([(year_, month_) for year_, month_, start, stop in pieces]))
+	month_index = np.array([months.index((year_, month_)) for year_, month_, start, stop in pieces], dtype=int)
+
+	tab = pd.DataFrame({'date': pd.Categorical.from_codes(np.repeat(month_index, n_rows),
+						categories=[year_+'-'+month_+'-01' for year_, month_ in months])})
+	for name in columns:
+		if name=='DOB_YY':
+			keys = np.array([int(year_) for year_, month_, start, stop in pieces], dtype=np.int16)
+			tab[name] = decode_store_column(np.repeat(keys, n_rows), 'int16')
+		elif name=='DOB_MM':
+			keys = np.array([int(month_) for year_, month_, start, stop in pieces], dtype=np.int8)
+			tab[name] = decode_store_column(np.repeat(keys, n_rows), 'int8')
+		else:
+			values = [np.load(os.path.join(partition_dir(store_dir, year_, month_), name+'.npy'), mmap_mode='r')[start:stop]
+						for year_, month_, start, stop in pieces]
+			values = np.concatenate(values) if len(values)>0 else np.array([], dtype=str)
+			tab[name] = decode_store_column(values, dtypes.get(name, 'str'))
+	return tab
+
+
+'''
+
+out-of-core aggregation
+the monthly series of aggregate_variables, computed on batches of rows that fit in a memory budget
+and merged as they come. only the aggregates are kept in memory, never the whole table.
+'''
+## bytes per row held while a batch is aggregated: the date index and the working arrays of aggregate_variables,
+## plus every column as loaded (compact dtype and its mask, or a python string read from the csv)
+aggregation_row_bytes = 48
+column_row_bytes = {'int8': 2, 'int16': 3, 'char': 2, 'str': 64}
+
+def batch_rows(memory_budget, columns, dtypes=None):
+	''' number of rows per batch that fits in memory_budget (bytes)'''
+	dtypes = dtypes or {}
+	row_bytes = aggregation_row_bytes+sum([column_row_bytes.get(dtypes.get(name, 'str'), 64) for name in columns])
+	return max(1, int(memory_budget//row_bytes))
+
+def iter_store_batches(store_dir, columns, years=None, memory_budget=2**30):
+	''' yield the store as tables (load_birth_store layout) of at most memory_budget bytes.
+	consecutive months are grouped together, a month larger than the budget is split'''
+	meta = load_store_meta(store_dir)
+	rows = batch_rows(memory_budget, columns, meta.get('dtypes', {}))
+	pieces = []
+	n_rows = 0
+	for year_, month_ in list_partitions(store_dir, years):
+		size = meta['partitions'][year_+'-'+month_]
+		start = 0
+		while start<size:
+			stop = min(size, start+rows-n_rows)
+			pieces.append((year_, month_, start, stop))
+			n_rows = n_rows+stop-start
+			start = stop
+			if n_rows==rows:
+				yield store_table(store_dir, meta, columns, pieces)
+				pieces = []
+				n_rows = 0
+	if len(pieces)>0:
+		yield store_table(store_dir, meta, columns, pieces)
+
+def iter_csv_batches(file_path, columns, memory_budget=2**30):
+	''' yield the legacy BigData csv as tables of at most memory_budget bytes (columns read as str)'''
+	rows = batch_rows(memory_budget, columns)
+	for chunk in pd.read_csv(file_path, dtype=str, usecols=['date']+list(columns), chunksize=rows):
+		yield chunk
+
+def merge_aggregates(total, results):
+	''' add the results of aggregate_variables to total (same layout), on the union of months and codes'''
+	for var1, result in results.items():
+		if var1 not in total:
+			total[var1] = result
+			continue
+		previous = total[var1]
+		time_series = np.union1d(previous['time_series'], result['time_series']).astype(object)
+		months = [np.searchsorted(time_series, part['time_series']) for part in [previous, result]]
+		if previous['codes'] is None:
+			codes = None
+			series = np.zeros(len(time_series))
+			for part, columns in zip([previous, result], months):
+				series[columns] += part['series']
+		else:
+			codes = np.union1d(previous['codes'], result['codes'])
+			series = np.zeros((len(codes), len(time_series)))
+			for part, columns in zip([previous, result], months):
+				series[np.ix_(np.searchsorted(codes, part['codes']), columns)] += part['series']
+		total[var1] = {'time_series': time_series, 'codes': codes, 'series': series}
+	return total
+
+def spec_columns(specs):
+	''' columns needed by the specs of aggregate_variables'''
+	columns = []
+	for spec in specs:
+		for name in [spec[0]]+(list(spec[2]) if len(spec)>2 else []):
+			if name not in columns:
+				columns.append(name)
+	return columns
+
+def aggregate_out_of_core(batches, specs):
+	''' aggregate_variables over an iterator of tables (iter_store_batches or iter_csv_batches),
+	same result as aggregate_variables on the whole table'''
+	total = {}
+	for n_batch, batch in enumerate(batches):
+		merge_aggregates(total, aggregate_variables(batch, specs))
+		print('aggregated batch ', n_batch+1, ', ', len(batch), ' rows')
+	return total
+
+
+'''
+
+shared-memory worker pool
+the date and the columns of the specs are encoded once in shared memory, every worker process maps them
+without a copy (no pickling of the table) and computes some of the series. only the monthly series travel back.
+'''
+def worker_context():
+	''' fork when available: workers don't need to re-import the calling script'''
+	if 'fork' in multiprocessing.get_all_start_methods():
+		return multiprocessing.get_context('fork')
+	return multiprocessing.get_context()
+
+def script_workers(n_workers):
+	''' number of worker processes for a pool started from the top-level code of a script (no __main__ guard):
+	1 without fork, since every spawned worker would run the whole script again (Windows)'''
+	if 'fork' not in multiprocessing.get_all_start_methods():
+		return 1
+	return n_workers
+
+def share_array(values):
+	''' copy values in a new shared memory block. returns the block and the descriptor to attach it'''
+	block = shared_memory.SharedMemory(create=True, size=max(1, values.nbytes))
+	np.ndarray(values.shape, dtype=values.dtype, buffer=block.buf)[:] = values
+	return block, (block.name, values.shape, values.dtype.str)
+
+def attach_array(descriptor):
+	name, shape, dtype = descriptor
+	block = shared_memory.SharedMemory(name=name)
+	return block, np.ndarray(shape, dtype=dtype, buffer=block.buf)
+
+def share_table(bigData, specs):
+	''' encode the date and the columns of specs in shared memory, the date and non numeric columns as
+	factorized codes (smallest integer type, like the codes of a categorical), numeric codes as integers with -1 for missing.
+	returns the blocks, to be released by the caller, and the descriptors of the table'''
+	numeric = [spec[0] for spec in specs if spec[1] in ['sum', 'count']]
+	date_index, time_series = factorize_dates(bigData['date'])
+	if isinstance(bigData, ColumnSelection):
+		date_index = np.where(bigData.mask, date_index, -1)
+	columns = {'date': (date_index, time_series)}
+	for name in spec_columns(specs):
+		if name in numeric:
+			columns[name] = (numeric_codes(bigData[name]), None)
+		else:
+			values, categories = pd.factorize(bigData[name], sort=True)
+			columns[name] = (values, np.asarray(categories, dtype=object))
+
+	blocks = []
+	table = {}
+	for name, (values, categories) in columns.items():
+		if categories is not None:
+			values = values.astype(np.min_scalar_type(-len(categories)-1))
+		block, descriptor = share_array(values)
+		blocks.append(block)
+		table[name] = (descriptor, categories)
+	return blocks, table
+
+def _aggregate_shared_job(job):
+	''' aggregate_variables in a worker, on a table rebuilt over the shared memory blocks'''
+	table, specs = job
+	blocks = []
+	columns = {}
+	for name, (descriptor, categories) in table.items():
+		block, values = attach_array(descriptor)
+		blocks.append(block)
+		if categories is None:
+			columns[name] = pd.arrays.IntegerArray(values, values==-1)
+		else:
+			columns[name] = pd.Categorical.from_codes(values, categories=categories)
+	results = aggregate_variables(pd.DataFrame(columns, copy=False), specs)
+	del columns, values
+	for block in blocks:
+		block.close()
+	return results
+
+def aggregate_parallel(bigData, specs, n_workers=None):
+	''' aggregate_variables with one spec per task, on a pool of n_workers processes (all cores by default)
+	sharing the encoded columns. same result as aggregate_variables'''
+	n_workers = min(len(specs), n_workers or os.cpu_count())
+	if n_workers<=1:
+		return aggregate_variables(bigData, specs)
+	blocks, table = share_table(bigData, specs)
+	results = {}
+	try:
+		with ProcessPoolExecutor(max_workers=n_workers, mp_context=worker_context()) as pool:
+			for result in pool.map(_aggregate_shared_job, [(table, [spec]) for spec in specs]):
+				results.update(result)
+	finally:
+		for block in blocks:
+			block.close()
+			block.unlink()
+	return results
+
+
+'''
+
+incremental ingest
+the manifest records every ingested file (size, modification time, checksum) and the settings used,
+so only new or changed year files are ingested again.
+aggregates computed from the store are kept per month, in store_dir/aggregates/<name>/<YYYY-MM>.*,
+and only the months of re-ingested years are invalidated.
+'''
+def file_checksum(file_path, block_size=2**24):
+	''' sha1 of a file, read in blocks'''
+	sha1 = hashlib.sha1()
+	with open(file_path, 'rb') as f:
+		block = f.read(block_size)
+		while len(block)>0:
+			sha1.update(block)
+			block = f.read(block_size)
+	return sha1.hexdigest()
+
+def load_ingest_manifest(store_dir):
+	file_path = os.path.join(store_dir, 'ingest_manifest.json')
+	if not os.path.exists(file_path):
+		return {'settings': None, 'files': {}}
+	with open(file_path) as f:
+		return json.load(f)
+
+def save_ingest_manifest(store_dir, manifest):
+	os.makedirs(store_dir, exist_ok=True)
+	with open(os.path.join(store_dir, 'ingest_manifest.json'), 'w') as f:
+		json.dump(manifest, f, indent=1)
+
+def plan_incremental_ingest(manifest, data_dir, year_files, schema, settings, store_dir):
+	''' years that need to be ingested: new files, changed files (checksum), changed column mapping (schema),
+	or years missing from the store. if the settings (columns, dtypes...) changed, every year is ingested again.
+	returns the years and the updated manifest entries of every year file'''
+	stored_years = set([year_ for year_, month_ in list_partitions(store_dir)])
+	years_ = []
+	entries = {}
+	for year_ in year_files:
+		file_path = data_dir+year_files[year_]
+		stat = os.stat(file_path)
+		entry = {'file': year_files[year_], 'size': stat.st_size, 'mtime': stat.st_mtime, 'columns': schema[year_]['columns']}
+		previous = manifest['files'].get(year_)
+		if previous is not None and previous['file']==entry['file'] and previous['size']==entry['size'] and previous['mtime']==entry['mtime']:
+			## unchanged file, no need to read it
+			entry['sha1'] = previous['sha1']
+		else:
+			entry['sha1'] = file_checksum(file_path)
+		entries[year_] = entry
+
+		if manifest['settings']!=settings or previous is None or previous['sha1']!=entry['sha1'] \
+			or previous.get('columns')!=entry['columns'] or year_ not in stored_years:
+			years_.append(year_)
+	return years_, entries
+
+def invalidate_aggregates(store_dir, months):
+	''' remove the per-month aggregates of months (YYYY-MM strings), so they are computed again'''
+	aggregates_dir = os.path.join(store_dir, 'aggregates')
+	if not os.path.isdir(aggregates_dir):
+		return []
+	removed = []
+	for name in os.listdir(aggregates_dir):
+		for file_ in os.listdir(os.path.join(aggregates_dir, name)):
+			if os.path.splitext(file_)[0] in months:
+				os.remove(os.path.join(aggregates_dir, name, file_))
+				removed.append(os.path.join(name, file_))
+	return removed
+
+
+'''
+
+pipeline stages
+a stage is a script, the directory it runs in, its inputs and its outputs (see run_pipeline.py).
+its fingerprint is a checksum of the script, ninja_functions.py and the inputs: the stage runs again
+only when the fingerprint changes or one of its outputs is missing.
+'''
+def fingerprint_file(file_path, content_limit=2**26):
+	''' checksum of the content of a file, or of its size and modification time above content_limit bytes
+	(the raw year files, whose content is checked by the ingest manifest)'''
+	stat = os.stat(file_path)
+	if stat.st_size>content_limit:
+		return 'stat:'+str(stat.st_size)+':'+str(stat.st_mtime)
+	return file_checksum(file_path)
+
+def module_definitions(module_path):
+	''' {name: source} of the top-level functions, classes and constants of a module'''
+	with open(module_path) as f:
+		source = f.read()
+	definitions = {}
+	for node in ast.parse(source).body:
+		if isinstance(node, (ast.FunctionDef, ast.ClassDef)):
+			definitions[node.name] = node
+		elif isinstance(node, ast.Assign):
+			for target in node.targets:
+				if isinstance(target, ast.Name):
+					definitions[target.id] = node
+	return {name: ast.get_source_segment(source, node) for name, node in definitions.items()}
+
+def code_fingerprint(script_path, module_path):
+	''' checksum of the definitions of the module the script uses (module.name in the script),
+	and of the definitions they use in turn: editing a function of the module only changes the scripts that call it'''
+	module = os.path.splitext(os.path.basename(module_path))[0]
+	definitions = module_definitions(module_path)
+	with open(script_path) as f:
+		tree = ast.parse(f.read())
+	used = set([node.attr for node in ast.walk(tree) if isinstance(node, ast.Attribute)
+				and isinstance(node.value, ast.Name) and node.value.id==module])
+	pending = [name for name in used if name in definitions]
+	used = set(pending)
+	while len(pending)>0:
+		for node in ast.walk(ast.parse(definitions[pending.pop()])):
+			if isinstance(node, ast.Name) and node.id in definitions and node.id not in used:
+				used.add(node.id)
+				pending.append(node.id)
+	checksum = hashlib.sha1()
+	for name in sorted(used):
+		checksum.update(name.encode())
+		checksum.update(definitions[name].encode())
+	return checksum.hexdigest()
+
+def stage_fingerprint(stage, base_dir='.'):
+	''' checksum of everything the stage depends on: its script, the definitions it uses from stage['modules']
+	and its inputs. inputs are files, directories (all their files) or glob patterns'''
+	checksum = hashlib.sha1()
+	script_path = os.path.join(base_dir, stage['script'])
+	for module in stage.get('modules', []):
+		checksum.update(module.encode())
+		checksum.update(code_fingerprint(script_path, os.path.join(base_dir, module)).encode())
+	paths = [stage['script']]+list(stage.get('inputs', []))
+	for path in paths:
+		files = []
+		for full_path in sorted(glob.glob(os.path.join(base_dir, path))) or [os.path.join(base_dir, path)]:
+			if os.path.isdir(full_path):
+				files = files+sorted([os.path.join(root, name) for root, dirs, names in os.walk(full_path) for name in names])
+			else:
+				files.append(full_path)
+		for file_path in files:
+			checksum.update(os.path.relpath(file_path, base_dir).encode())
+			checksum.update((fingerprint_file(file_path) if os.path.exists(file_path) else 'missing').encode())
+	checksum.update(json.dumps(stage.get('params', {}), sort_keys=True).encode())
+	return checksum.hexdigest()
+
+def load_pipeline_state(state_file):
+	if not os.path.exists(state_file):
+		return {}
+	with open(state_file) as f:
+		return json.load(f)
+
+def save_pipeline_state(state_file, state):
+	with open(state_file, 'w') as f:
+		json.dump(state, f, indent=1)
+
+def stage_is_current(stage, state, base_dir='.'):
+	''' True when the stage ran with the same fingerprint and all its outputs are there'''
+	outputs_exist = all([os.path.exists(os.path.join(base_dir, path)) for path in stage.get('outputs', [])])
+	return outputs_exist and state.get(stage['name'], {}).get('fingerprint')==stage_fingerprint(stage, base_dir)
+
+def run_stage(stage, base_dir='.'):
+	''' run the script of the stage in its directory, with the same python. returns the exit code'''
+	script = os.path.abspath(os.path.join(base_dir, stage['script']))
+	cwd = os.path.join(base_dir, stage.get('cwd', '.'))
+	return subprocess.run([sys.executable, script], cwd=cwd).returncode
+
+
 '''
 
 birth functions
@@ -99,6 +1172,105 @@ the goal is to have functions as generalizable as possible; right now I have thr
 2. count a total based from a number code
 3. count a total based from a letter code
 '''
+def factorize_dates(dates):
+	''' month index of every row (-1 for missing dates) and the sorted unique dates (time_series).
+	works for the string dates of the csv and the categorical dates of the store'''
+	date_index, time_series = pd.factorize(dates, sort=True)
+	return date_index, np.asarray(time_series, dtype=object)
+
+##################################################################################
+######## fused aggregation: every series in one scan of the table
+def numeric_codes(column):
+	''' integer values of a code column (csv strings or store integers), -1 where missing.
+	store columns keep their narrow integer type (int8...)'''
+	if pd.api.types.is_signed_integer_dtype(column.dtype):
+		## numpy_dtype of the nullable integers (Int8...), plain numpy integer columns have their own dtype
+		return column.to_numpy(dtype=getattr(column.dtype, 'numpy_dtype', column.dtype), na_value=-1)
+	if pd.api.types.is_integer_dtype(column.dtype):
+		return column.to_numpy(dtype=np.int64, na_value=-1)
+	## a copy: with the str dtype of recent pandas, to_numpy can return the column itself
+	values = column.to_numpy(dtype=object, copy=True)
+	missing = pd.isna(values)
+	values[missing] = -1
+	return values.astype(int)
+
+class ColumnSelection:
+	''' lightweight selection of columns of bigData: references to the columns plus the mask of rows
+	where none of them is missing. nothing is copied, the counting functions (aggregate_variables,
+	compute_births, collect_variable...) take it in place of a cleaned copy of the table'''
+	def __init__(self, bigData, columns):
+		self.data = bigData
+		self.columns = list(columns)
+		self.mask = np.ones(len(bigData), dtype=bool)
+		for name in self.columns:
+			self.mask &= bigData[name].notna().to_numpy()
+
+	def __getitem__(self, name):
+		return self.data[name]
+
+	def __len__(self):
+		return int(np.sum(self.mask))
+
+def aggregate_variables(bigData, specs):
+	''' all the monthly series of specs, with a single factorization of the date and a single pass over each column.
+	bigData is the table, or a ColumnSelection of it (its null mask is applied on the fly).
+	specs: list of (var1, mode) or (var1, mode, other_columns)
+		mode 'sum'		sum of var1 per month (compute_births)
+		mode 'count'	rows of every numeric code per month (collect_variable)
+		mode 'letter'	rows of every letter code per month (collect_YayNay_variable)
+		other_columns	rows where these are missing are also left out (same as the dropna of get_two_column)
+	returns {var1: {'time_series':..., 'codes':..., 'series':...}}
+	series is a 1-d array for 'sum' (codes is None), and g[code, month] for the other modes'''
+	date_index, time_series = factorize_dates(bigData['date'])
+	if isinstance(bigData, ColumnSelection):
+		selected = bigData.mask & (date_index>=0)
+	else:
+		selected = date_index>=0
+	notna = {}
+	results = {}
+	for spec in specs:
+		var1, mode = spec[0], spec[1]
+		other_columns = list(spec[2]) if len(spec)>2 else []
+
+		## rows with the date and every required column
+		valid = selected
+		for name in [var1]+other_columns:
+			if name not in notna:
+				notna[name] = bigData[name].notna().to_numpy()
+			valid = valid & notna[name]
+
+		## only the months with data for this variable, like the unique dates of the clean table
+		month_index = date_index[valid]
+		present = np.bincount(month_index, minlength=len(time_series))>0
+		month_index = (np.cumsum(present)-1)[month_index]
+		n_months = int(np.sum(present))
+
+		if mode=='sum':
+			values = numeric_codes(bigData[var1])[valid]
+			series = np.bincount(month_index, weights=values, minlength=n_months)
+			codes = None
+		elif mode in ['count', 'letter']:
+			if mode=='count':
+				## codes are compared as integers ('01' and '1' are the same code), offset to start at 0
+				values = numeric_codes(bigData[var1])[valid].astype(np.int64)
+				offset = np.min(values) if len(values)>0 else 0
+				code_index = values-offset
+				codes = np.arange(np.max(code_index)+1 if len(values)>0 else 0)+offset
+			else:
+				code_index, codes = pd.factorize(bigData[var1], sort=True)
+				code_index = code_index[valid]
+			## only the codes found in the selected rows
+			observed = np.bincount(code_index, minlength=len(codes))>0
+			code_index = (np.cumsum(observed)-1)[code_index]
+			codes = np.asarray(codes)[observed]
+			flat_index = code_index*n_months+month_index
+			series = np.bincount(flat_index, minlength=len(codes)*n_months).astype(float).reshape(len(codes), n_months)
+		else:
+			raise ValueError('unknown counting mode: '+str(mode))
+
+		results[var1] = {'time_series': time_series[present], 'codes': codes, 'series': series}
+	return results
+
 ##################################################################################
 ######## 1. integer numeric input 
 def compute_births(var1,tab, label):
@@ -106,90 +1278,557 @@ def compute_births(var1,tab, label):
 	print(tab.columns,'\n')
 	# tab.to_csv('output_figures/tab.csv')
 
-	###### loop parameters:
-	time_series = tab['date'].unique()
-	time_series = np.sort(time_series)
-
-	birthseries = np.array([])
 	##### information on current process
 	tik = time.perf_counter()
-	print('started loop for ', label, ', t= ', datetime.now().time())
-	##### actual loop
-	for x in range(0,len(time_series)):
-		current_date = time_series[x]
-		babies_0 = tab[var1][tab.date==current_date].values.astype(int)
-		babies_day = np.sum(tab[var1][tab.date==current_date].values.astype(int))
+	print('started counting ', label, ', t= ', datetime.now().time())
+	result = aggregate_variables(tab, [(var1, 'sum')])[var1]
+	time_series, birthseries = result['time_series'], result['series']
 
-		birthseries= np.append(birthseries, babies_day)
-		# print('date',current_date,'babiesday' ,babies_day,'\n',babies_0,'\n \n')
-		print('date',current_date,', babies born' ,babies_day)
+	for x in range(0,len(time_series)):
+		print('date',time_series[x],', babies born' ,int(birthseries[x]))
 
 	tok = time.perf_counter()
 	DT= (tok-tik)/60
 	DT_= '%.2f' % DT
-	###### report time on loop
-	print('finished loop, time: ',DT_,' minutes \n')
+	###### report time
+	print('finished counting, time: ',DT_,' minutes \n')
 
 	return time_series, birthseries
 
-
 ##################################################################################
 ######## 2. numeric code input
 def collect_variable(tab,var1):
-	###########################################
-	###########################################
-	# print(tab.columns, '\n')
-	###### loop parameters:
-	time_series = tab['date'].unique()
-	time_series = np.sort(time_series)
+	result = aggregate_variables(tab, [(var1, 'count')])[var1]
+	print('Procesing variable ', var1, ', number of codes: ',len(result['codes']))
+	return result['time_series'], result['series']
 
-	codes = np.unique(tab[var1].values.astype(int))
-	g = np.zeros((len(codes),len(time_series)))
+##################################################################################
+######## 3. letter code input
+def collect_YayNay_variable(tab,var1):
+	result = aggregate_variables(tab, [(var1, 'letter')])[var1]
+	print('Procesing variable ', var1, ', number of codes: ',len(result['codes']))
+	return result['time_series'], result['series']
 
-	print('Procesing variable ', var1, ', number of codes: ',len(codes))
-	
-	for y in range(0,len(time_series)):
-		current_date = time_series[y]
-		MAGE = tab[var1][tab.date==current_date].values.astype(int)
 
-		for x in range(0,len(codes)):
-			current_code = codes[x]
-			g[x,y] = len(MAGE[MAGE==current_code])
+'''
 
+value counts
+number of births of every value of every common column, per month, counted during the ingest
+(store_dir/aggregates/value_counts/<YYYY-MM>.json). the monthly series of any CDC variable
+is then available without loading the microdata.
+'''
+def count_chunk_values(values, month_index, totals=None):
+	''' add the number of rows of every value of a column of a chunk, per month (0 to 11), to totals.
+	totals: (values, values x 12 counts) of the previous chunks, or None. missing values are not counted'''
+	value_index, uniques = pd.factorize(values)
+	valid = (value_index>=0) & (month_index>=0)
+	counts = np.bincount(value_index[valid]*12+month_index[valid], minlength=len(uniques)*12).reshape(len(uniques), 12)
+	if totals is None:
+		return pd.Index(uniques), counts
+	known, total_counts = totals
+	## rows of the values already seen, new values are appended
+	rows = known.get_indexer(uniques)
+	new = rows<0
+	rows[new] = len(known)+np.arange(np.sum(new))
+	total_counts = np.vstack([total_counts, np.zeros((np.sum(new), 12), dtype=total_counts.dtype)])
+	total_counts[rows] += counts
+	return known.append(pd.Index(uniques[new])), total_counts
+
+def write_value_counts(store_dir, value_counts):
+	''' value_counts: {column: values x dates table}. one json file per month'''
+	value_dir = os.path.join(store_dir, 'aggregates', 'value_counts')
+	os.makedirs(value_dir, exist_ok=True)
+	months = {}
+	for name, totals in value_counts.items():
+		values = [str(value).strip() for value in totals.index]
+		counts = totals.to_numpy()
+		for j, date_ in enumerate(totals.columns):
+			## only the months with births
+			if np.sum(counts[:, j])==0:
+				continue
+			column_counts = months.setdefault(date_[0:7], {}).setdefault(name, {})
+			for i in np.flatnonzero(counts[:, j]):
+				column_counts[values[i]] = column_counts.get(values[i], 0)+int(counts[i, j])
+	for month_, counts in months.items():
+		with open(os.path.join(value_dir, month_+'.json'), 'w') as f:
+			json.dump(counts, f, separators=(',', ':'))
+
+def load_value_counts(store_dir, column, years=None):
+	''' monthly series of every value of column, from the ingest sidecar.
+	returns time_series, codes, g[code, month] like collect_variable (codes as integers when they all are)'''
+	value_dir = os.path.join(store_dir, 'aggregates', 'value_counts')
+	months = [year_+'-'+month_ for year_, month_ in list_partitions(store_dir, years)
+				if os.path.exists(os.path.join(value_dir, year_+'-'+month_+'.json'))]
+	counts = []
+	for month_ in months:
+		with open(os.path.join(value_dir, month_+'.json')) as f:
+			counts.append(json.load(f).get(column, {}))
+	table = pd.DataFrame(counts).fillna(0).T
+	if len(table)>0 and all([value.lstrip('-').isdigit() for value in table.index]):
+		## '01' and '1' are the same code
+		table.index = table.index.astype(int)
+		table = table.groupby(level=0).sum()
+	table = table.sort_index()
+	time_series = np.array([month_+'-01' for month_ in months], dtype=object)
+	return time_series, np.asarray(table.index), table.to_numpy(dtype=float).reshape(len(table), len(months))
 
-	return time_series, g
 
-##################################################################################
-######## 3. letter code input
-def collect_YayNay_variable(tab,var1):
-	###########################################
-	###########################################
-	# print(tab.columns, '\n')
-	###### loop parameters:
-	time_series = tab['date'].unique()
-	time_series = np.sort(time_series)
+'''
+
+variable queries
+monthly series of any CDC variable on demand (see query_variable.py): only its column is read from the store,
+or its value counts for the columns that are not stored. the results are kept in an on-disk LRU cache
+(one .npz per variable, years and version of the store), so a repeated query doesn't touch the store.
+'''
+def query_mode(dtype):
+	''' counting mode of aggregate_variables for a column of the store'''
+	return 'letter' if dtype in ['char', 'str'] else 'count'
+
+def store_fingerprint(store_dir):
+	''' checksum of the store metadata and ingest manifest: changes whenever the store is written'''
+	checksum = hashlib.sha1()
+	for name in ['store_meta.json', 'ingest_manifest.json']:
+		file_path = os.path.join(store_dir, name)
+		if os.path.exists(file_path):
+			with open(file_path, 'rb') as f:
+				checksum.update(f.read())
+	return checksum.hexdigest()
+
+def monthly_births(store_dir, years=None):
+	''' time_series and number of births of every month, from the row counts of the store'''
+	meta = load_store_meta(store_dir)
+	partitions = list_partitions(store_dir, years)
+	time_series = np.array([year_+'-'+month_+'-01' for year_, month_ in partitions], dtype=object)
+	return time_series, np.array([meta['partitions'][year_+'-'+month_] for year_, month_ in partitions], dtype=float)
+
+def read_query_cache(cache_file):
+	''' cached result, None when it is not in the cache. a hit makes it the most recently used'''
+	if not os.path.exists(cache_file):
+		return None
+	with np.load(cache_file) as cached:
+		result = {'time_series': cached['time_series'].astype(object), 'codes': cached['codes'], 'series': cached['series']}
+	os.utime(cache_file)
+	return result
+
+def write_query_cache(cache_file, result, cache_size=64):
+	''' add result to the cache, and remove the least recently used files beyond cache_size'''
+	cache_dir = os.path.dirname(cache_file)
+	os.makedirs(cache_dir, exist_ok=True)
+	codes = np.asarray(result['codes'])
+	if codes.dtype==object:
+		codes = codes.astype(str)
+	np.savez(cache_file, time_series=np.asarray(result['time_series']).astype(str), codes=codes, series=result['series'])
+	files = [os.path.join(cache_dir, name) for name in os.listdir(cache_dir) if name.endswith('.npz')]
+	files = sorted(files, key=os.path.getmtime)
+	for file_path in files[:max(0, len(files)-cache_size)]:
+		os.remove(file_path)
+
+def queryable_variables(store_dir):
+	''' the variables query_variables can answer: the columns of the store and the ones of its value counts'''
+	value_dir = os.path.join(store_dir, 'aggregates', 'value_counts')
+	names = set(load_store_meta(store_dir)['columns'])
+	for file_name in sorted(glob.glob(os.path.join(value_dir, '*.json'))):
+		with open(file_name) as f:
+			names.update(json.load(f).keys())
+	return sorted(names)
+
+def query_variables(store_dir, variables, years=None, cache_dir=None, cache_size=64):
+	''' monthly series of every code of every variable: {var1: {'time_series':..., 'codes':..., 'series':...}},
+	like aggregate_variables. variables not in the store come from the value counts of the ingest'''
+	meta = load_store_meta(store_dir)
+	store_key = store_fingerprint(store_dir)
+	results = {}
+	cache_files = {}
+	for var1 in variables:
+		if cache_dir is not None:
+			key = hashlib.sha1(json.dumps([store_key, var1, sorted([str(y) for y in years or []])]).encode()).hexdigest()
+			cache_files[var1] = os.path.join(cache_dir, var1+'_'+key[0:16]+'.npz')
+			cached = read_query_cache(cache_files[var1])
+			if cached is not None:
+				results[var1] = cached
+
+	missing = [var1 for var1 in variables if var1 not in results]
+	stored = [var1 for var1 in missing if var1 in meta['columns']]
+	if len(stored)>0:
+		## only these columns are read (memory-mapped) from the store
+		tab = load_birth_store(store_dir, stored, years)
+		results.update(aggregate_variables(tab, [(var1, query_mode(meta['dtypes'].get(var1, 'str'))) for var1 in stored]))
+	for var1 in missing:
+		if var1 in stored:
+			continue
+		time_series, codes, g = load_value_counts(store_dir, var1, years)
+		if len(codes)==0:
+			raise ValueError(var1+' is neither in the store nor in its value counts')
+		results[var1] = {'time_series': time_series, 'codes': codes, 'series': g}
+
+	for var1 in missing:
+		if cache_dir is not None:
+			write_query_cache(cache_files[var1], results[var1], cache_size)
+	return {var1: results[var1] for var1 in variables}
 
-	codes = np.unique(tab[var1].values)
-	g = np.zeros((len(codes),len(time_series)))
 
-	print('Procesing variable ', var1, ', number of codes: ',len(codes))
-	
-	for y in range(0,len(time_series)):
-		current_date = time_series[y]
-		MAGE = tab[var1][tab.date==current_date]
+'''
+
+data cube
+counts of every combination of codes of a few columns, per month, built once from the store
+(store_dir/aggregates/cube_<COLUMNS>/<YYYY-MM>.npy) so multivariate questions don't need the microdata
+'''
+def store_missing_value(dtype):
+	''' value used for missing data by encode_store_column'''
+	if dtype=='str':
+		return ''
+	if dtype=='char':
+		return 0
+	return -1
+
+def decode_store_codes(codes, dtype):
+	''' stored codes to the values seen in the data (letters for char columns)'''
+	if dtype=='char':
+		return np.array([chr(code) for code in codes], dtype=object)
+	return np.asarray(codes)
+
+class DataCube:
+	''' counts[code of columns[0], ..., code of columns[-1], month]
+	codes[i] are the (sorted) codes of columns[i], time_series the months (YYYY-MM-01)'''
+	def __init__(self, columns, codes, time_series, counts):
+		self.columns = list(columns)
+		self.codes = [np.asarray(code_list) for code_list in codes]
+		self.time_series = np.asarray(time_series, dtype=object)
+		self.counts = counts
+
+	def marginal(self, columns):
+		''' roll-up: cube of columns only (in that order), summed over the other columns'''
+		keep = [self.columns.index(name) for name in columns]
+		drop = tuple([axis for axis in range(len(self.columns)) if axis not in keep])
+		counts = self.counts.sum(axis=drop)
+		order = np.argsort(np.argsort(keep))
+		counts = np.transpose(counts, list(order)+[len(keep)])
+		return DataCube(columns, [self.codes[axis] for axis in keep], self.time_series, counts)
+
+	def slice(self, **selection):
+		''' rows with column==code (that column is dropped) or column in [codes] (the column is kept)'''
+		counts = self.counts
+		columns, codes = [], []
+		index = []
+		for axis, name in enumerate(self.columns):
+			if name not in selection:
+				index.append(slice(None))
+				columns.append(name)
+				codes.append(self.codes[axis])
+			elif np.ndim(selection[name])==0:
+				index.append(int(np.flatnonzero(self.codes[axis]==selection[name])[0]))
+			else:
+				positions = np.array([np.flatnonzero(self.codes[axis]==code)[0] for code in selection[name]], dtype=int)
+				index.append(positions)
+				columns.append(name)
+				codes.append(self.codes[axis][positions])
+		## one axis at a time, so lists of codes don't get broadcast together
+		for axis in reversed(range(len(index))):
+			selector = [slice(None)]*counts.ndim
+			selector[axis] = index[axis]
+			counts = counts[tuple(selector)]
+		return DataCube(columns, codes, self.time_series, counts)
+
+	def series(self, column=None):
+		''' births per month (column=None), or g[code, month] of column, like collect_variable'''
+		if column is None:
+			return self.counts.reshape(-1, len(self.time_series)).sum(axis=0).astype(float)
+		return self.marginal([column]).counts.astype(float)
+
+def data_cube_dir(store_dir, columns):
+	return os.path.join(store_dir, 'aggregates', 'cube_'+'_'.join(columns))
+
+def build_data_cube(store_dir, columns, years=None):
+	''' count the code combinations of columns in every month of the store that is not in the cube yet.
+	the codes of every month are kept in axes.json, so only these months are read.
+	a change of the code domain of any column rebuilds every month'''
+	tik = time.perf_counter()
+	meta = load_store_meta(store_dir)
+	dtypes = [meta['dtypes'].get(name, 'str') for name in columns]
+	partitions = list_partitions(store_dir, years)
+
+	cube_dir = data_cube_dir(store_dir, columns)
+	axes_file = os.path.join(cube_dir, 'axes.json')
+	previous = {}
+	if os.path.exists(axes_file):
+		with open(axes_file) as f:
+			previous = json.load(f)
+	## codes of every column in every month, kept in axes.json: only the months without a cube file are scanned
+	month_domains = previous.get('month_domains', {}) if previous.get('columns')==list(columns) else {}
+	for year_, month_ in partitions:
+		month_key = year_+'-'+month_
+		if month_key in month_domains and os.path.exists(os.path.join(cube_dir, month_key+'.npy')):
+			continue
+		month_domains[month_key] = [np.unique(np.load(os.path.join(partition_dir(store_dir, year_, month_), name+'.npy'), mmap_mode='r')).tolist()
+									for name in columns]
+
+	## code domain of every column: sorted codes found in the months of the store
+	domains = []
+	for n_column, dtype in enumerate(dtypes):
+		uniques = set()
+		for year_, month_ in partitions:
+			uniques.update(month_domains[year_+'-'+month_][n_column])
+		uniques.discard(store_missing_value(dtype))
+		domains.append(np.array(sorted(uniques)))
+
+	axes = {'columns': list(columns), 'dtypes': dtypes, 'domains': [domain.tolist() for domain in domains]}
+	if any([previous.get(key)!=axes[key] for key in axes]) and os.path.isdir(cube_dir):
+		shutil.rmtree(cube_dir)
+	os.makedirs(cube_dir, exist_ok=True)
+	axes['month_domains'] = month_domains
+	with open(axes_file, 'w') as f:
+		json.dump(axes, f)
+
+	shape = [len(domain) for domain in domains]
+	for year_, month_ in partitions:
+		cube_file = os.path.join(cube_dir, year_+'-'+month_+'.npy')
+		if os.path.exists(cube_file):
+			continue
+		positions = []
+		valid = None
+		for name, dtype, domain in zip(columns, dtypes, domains):
+			values = np.load(os.path.join(partition_dir(store_dir, year_, month_), name+'.npy'), mmap_mode='r')
+			present = values!=store_missing_value(dtype)
+			valid = present if valid is None else valid & present
+			positions.append(np.searchsorted(domain, values))
+		flat_index = np.ravel_multi_index([position[valid] for position in positions], shape)
+		counts = np.bincount(flat_index, minlength=int(np.prod(shape))).reshape(shape)
+		np.save(cube_file, counts, allow_pickle=False)
+	tok = time.perf_counter()
+	print('data cube ', columns, ', time: ', '%.2f' % ((tok-tik)/60), ' minutes')
+	return load_data_cube(store_dir, columns, years)
+
+def load_data_cube(store_dir, columns, years=None):
+	''' DataCube of columns from the aggregates of the store (see build_data_cube)'''
+	cube_dir = data_cube_dir(store_dir, columns)
+	with open(os.path.join(cube_dir, 'axes.json')) as f:
+		axes = json.load(f)
+	months = [year_+'-'+month_ for year_, month_ in list_partitions(store_dir, years)
+				if os.path.exists(os.path.join(cube_dir, year_+'-'+month_+'.npy'))]
+	shape = [len(domain) for domain in axes['domains']]
+	counts = np.zeros(shape+[len(months)], dtype=np.int64)
+	for x in range(0, len(months)):
+		counts[..., x] = np.load(os.path.join(cube_dir, months[x]+'.npy'))
+	codes = [decode_store_codes(domain, dtype) for domain, dtype in zip(axes['domains'], axes['dtypes'])]
+	return DataCube(axes['columns'], codes, [month+'-01' for month in months], counts)
+
+
+'''
+
+bitmap indexes
+one bitmap per (column, code) and month, the bit of a row is set where column==code.
+stored compressed in store_dir/aggregates/bitmaps/<YYYY-MM>.npz, so filtered monthly counts
+are ANDs/ORs of bitmaps instead of full scans of the table.
+predicates:
+	('MAGER9', 2)				MAGER9==2
+	('PREVIS_REC', [1,2])		PREVIS_REC is 1 or 2
+	('and', p1, p2, ...), ('or', p1, p2, ...), ('not', p)
+	(not also keeps the rows where the column is missing)
+'''
+_popcount = np.array([bin(x).count('1') for x in range(256)], dtype=np.uint8)
+
+def bitmap_key(column, code):
+	return str(column)+'='+str(code)
+
+def build_bitmap_index(store_dir, columns, years=None):
+	''' bitmaps of every code of columns, for the months of the store that don't have them yet'''
+	tik = time.perf_counter()
+	meta = load_store_meta(store_dir)
+	bitmap_dir = os.path.join(store_dir, 'aggregates', 'bitmaps')
+	os.makedirs(bitmap_dir, exist_ok=True)
+	for year_, month_ in list_partitions(store_dir, years):
+		bitmap_file = os.path.join(bitmap_dir, year_+'-'+month_+'.npz')
+		if os.path.exists(bitmap_file):
+			with np.load(bitmap_file) as bitmaps:
+				if list(bitmaps['_columns'])==list(columns):
+					continue
+		bitmaps = {'_columns': np.array(columns), '_rows': np.array([meta['partitions'][year_+'-'+month_]])}
+		for name in columns:
+			dtype = meta['dtypes'].get(name, 'str')
+			values = np.load(os.path.join(partition_dir(store_dir, year_, month_), name+'.npy'), mmap_mode='r')
+			codes = np.unique(values)
+			codes = codes[codes!=store_missing_value(dtype)]
+			for code, label in zip(codes, decode_store_codes(codes, dtype)):
+				bitmaps[bitmap_key(name, label)] = np.packbits(values==code)
+		np.savez_compressed(bitmap_file, **bitmaps)
+	tok = time.perf_counter()
+	print('bitmap index ', columns, ', time: ', '%.2f' % ((tok-tik)/60), ' minutes')
+
+def _evaluate_bitmap(bitmaps, predicate, n_rows):
+	n_bytes = (n_rows+7)//8
+	operator = predicate[0]
+	if operator=='and':
+		result = _evaluate_bitmap(bitmaps, predicate[1], n_rows)
+		for term in predicate[2:]:
+			result = result & _evaluate_bitmap(bitmaps, term, n_rows)
+		return result
+	if operator=='or':
+		result = _evaluate_bitmap(bitmaps, predicate[1], n_rows)
+		for term in predicate[2:]:
+			result = result | _evaluate_bitmap(bitmaps, term, n_rows)
+		return result
+	if operator=='not':
+		## the padding bits of the last byte stay off
+		return np.invert(_evaluate_bitmap(bitmaps, predicate[1], n_rows)) & np.packbits(np.ones(n_rows, dtype=bool))
+	column, codes = predicate
+	## a code without a bitmap has no births in the month, a column without bitmaps is an error
+	if column not in list(bitmaps['_columns']):
+		raise KeyError('no bitmap index for column '+str(column)+', indexed columns: '+', '.join(bitmaps['_columns'].tolist()))
+	if np.ndim(codes)==0:
+		codes = [codes]
+	result = np.zeros(n_bytes, dtype=np.uint8)
+	for code in codes:
+		key = bitmap_key(column, code)
+		if key in bitmaps.files:
+			result = result | bitmaps[key]
+	return result
+
+def bitmap_count(store_dir, predicate, years=None):
+	''' number of births per month where predicate is true (see the predicates above).
+	returns time_series, counts like compute_births'''
+	bitmap_dir = os.path.join(store_dir, 'aggregates', 'bitmaps')
+	time_series = []
+	counts = []
+	for year_, month_ in list_partitions(store_dir, years):
+		with np.load(os.path.join(bitmap_dir, year_+'-'+month_+'.npz')) as bitmaps:
+			n_rows = int(bitmaps['_rows'][0])
+			result = _evaluate_bitmap(bitmaps, predicate, n_rows)
+		time_series.append(year_+'-'+month_+'-01')
+		counts.append(np.sum(_popcount[result], dtype=np.int64))
+	return np.array(time_series, dtype=object), np.array(counts, dtype=float)
 
-		for x in range(0,len(codes)):
-			current_code = codes[x]
-			g[x,y] = len(MAGE[MAGE==current_code])
 
+'''
 
-	return time_series, g
+asynchronous loading
+the small independent inputs (keyDates, census tables, codebook) are read by a pool of threads
+while the main thread loads the births: the startup takes as long as the slowest input, not their sum.
+'''
+def start_input_loaders(loaders, n_threads=8):
+	''' loaders: {name: function without arguments}, every function is started on a thread pool.
+	returns {name: future}, future.result() waits for that input only (and raises its error, if any)'''
+	pool = ThreadPoolExecutor(max_workers=max(1, min(n_threads, len(loaders))))
+	futures = {name: pool.submit(loader) for name, loader in loaders.items()}
+	## the threads finish their work, no new task is accepted
+	pool.shutdown(wait=False)
+	return futures
 
 
 '''
 
 census functions
 '''
+## age brackets of the ACS S0101 tables, in the order of get_pop_percentages
+census_age_brackets = ['Under 5 years', '5 to 9 years', '10 to 14 years', '15 to 19 years', '20 to 24 years',
+			'25 to 29 years', '30 to 34 years', '35 to 39 years', '40 to 44 years', '45 to 49 years', '50 to 54 years',
+			'55 to 59 years', '60 to 64 years', '65 to 69 years', '70 to 74 years', '75 to 79 years', '80 to 84 years',
+			'85 years and over']
+## brackets of the women of childbearing age (15 to 44 years)
+childbearing_brackets = slice(3, 9)
+
+def census_layout(tab):
+	''' 'grouping': one row per label, the format of the 2021 download (Label (Grouping) column)
+	'coded': one column per estimate (S0101_C01_001E...), the labels in the first row (1Y and 5Y tables)'''
+	if 'Label (Grouping)' in tab.columns:
+		return 'grouping'
+	if 'S0101_C01_001E' in tab.columns:
+		return 'coded'
+	raise ValueError('unknown census table layout: '+str(list(tab.columns[0:5])))
+
+def census_estimates(tab, group='Total'):
+	''' total population and the estimate of every age bracket of group (Total, Male or Female), as published:
+	counts in most years, percent of the total in the 2015 and 2016 tables'''
+	if census_layout(tab)=='grouping':
+		labels = tab['Label (Grouping)'].astype(str).str.strip()
+		values = tab['United States!!'+group+'!!Estimate'].astype(str).str.replace(',', '')
+		## first occurrence: the AGE section, before the selected age categories
+		rows = [labels[labels==label].index[0] for label in ['Total population']+census_age_brackets]
+		values = values[rows]
+	else:
+		## the first row holds the labels of the estimates, e.g. Total!!Estimate!!AGE!!Under 5 years (2015)
+		## or Estimate!!Female!!AGE!!Under 5 years (2017)
+		parts = {column: str(label).split('!!') for column, label in tab.iloc[0].items()}
+		columns = []
+		for label in ['Total population']+census_age_brackets:
+			matches = [column for column, part in parts.items() if 'Estimate' in part and group in part and part[-1]==label]
+			if len(matches)==0:
+				raise ValueError('no '+group+' estimate of '+label+' in the census table')
+			columns.append(matches[0])
+		values = tab.loc[1, columns].astype(str).str.replace(',', '')
+	values = values.astype(float).to_numpy()
+	return int(values[0]), values[1:]
+
+def census_counts(tab, group='Total'):
+	''' total population and number of people of every age bracket, percentages are converted to counts'''
+	total, values = census_estimates(tab, group)
+	## percentages add up to about 100, counts to the total population
+	if np.sum(values)<total/2:
+		values = values*total/100
+	return total, values
+
+## part of the sources of the census cache: increase it when census_estimates or census_counts change,
+## the cached populations are parsed again
+census_cache_format = 1
+
+class CensusPopulation:
+	''' population of every age bracket, per year and group (Total, Female), from the ACS S0101 tables.
+	the csv files are parsed once and kept in a binary file (census_population.npz in census_dir),
+	used as long as census_cache_format, the list of files and their modification times don't change'''
+	groups = ['Total', 'Female']
+
+	def __init__(self, census_dir, census_files, cache_name='census_population.npz'):
+		''' census_files: {year: file name}, e.g. {'2020': 'ACSST5Y2020.S0101-Data.csv'}'''
+		self.years = sorted([str(year_) for year_ in census_files])
+		self.cache_path = os.path.join(census_dir, cache_name)
+		self.sources = np.array(['format:'+str(census_cache_format)]+[year_+':'+census_files[year_]+':'+str(os.stat(os.path.join(census_dir, census_files[year_])).st_mtime)
+							for year_ in self.years])
+		self.totals, self.population = self._load(census_dir, census_files)
+
+	def _load(self, census_dir, census_files):
+		if os.path.exists(self.cache_path):
+			with np.load(self.cache_path) as cached:
+				if np.array_equal(cached['sources'], self.sources):
+					return cached['totals'], cached['population']
+		## totals[group, year], population[group, year, bracket]
+		totals = np.zeros((len(self.groups), len(self.years)))
+		population = np.zeros((len(self.groups), len(self.years), len(census_age_brackets)))
+		for n_year, year_ in enumerate(self.years):
+			tab = pd.read_csv(os.path.join(census_dir, census_files[year_]), dtype=str)
+			for n_group, group in enumerate(self.groups):
+				totals[n_group, n_year], population[n_group, n_year] = census_counts(tab, group)
+		try:
+			np.savez(self.cache_path, sources=self.sources, totals=totals, population=population)
+		except OSError:
+			print('could not write census cache ', self.cache_path)
+		return totals, population
+
+	def brackets(self, group='Total'):
+		''' year x bracket array of group'''
+		return self.population[self.groups.index(group)]
+
+	def total(self, group='Total'):
+		return self.totals[self.groups.index(group)]
+
+	def women_15_44(self):
+		''' number of women 15 to 44 years old, per year'''
+		return np.sum(self.brackets('Female')[:, childbearing_brackets], axis=1)
+
+_census = {}
+def load_census_population(census_dir, census_files):
+	''' CensusPopulation of census_dir, parsed once per process'''
+	key = (census_dir, tuple(sorted(census_files.items())))
+	if key not in _census:
+		_census[key] = CensusPopulation(census_dir, census_files)
+	return _census[key]
+
+def birth_rate_series(birthseries, time_series, census):
+	''' births per 1,000 women 15 to 44 years old, every month (NaN for the years without census data)'''
+	women = np.full(len(time_series), np.nan)
+	for year_, population in zip(census.years, census.women_15_44()):
+		population_series, t_series = make_population_series(population, year_, time_series)
+		women[np.isin(time_series, t_series)] = population_series
+	return 1000*np.asarray(birthseries, dtype=float)/women
+
 def get_pop_percentages_F21(tab):
 
 	''' (...) From the documentation. For further details read in census_data
@@ -250,30 +1889,8 @@ def get_pop_percentages_F21(tab):
 	40                                          Sex
 	41                                          Age
 	'''
-	# print(pop21['Label (Grouping)'],pop21['United States!!Total!!Estimate'])
-	tab['United States!!Total!!Estimate'] = tab['United States!!Total!!Estimate'].str.replace(',','')
-	total = int(tab['United States!!Total!!Estimate'][0])
-	under_5 = float(tab['United States!!Total!!Estimate'][2])
-	five_9 = float(tab['United States!!Total!!Estimate'][3])
-	ten_14 = float(tab['United States!!Total!!Estimate'][4])
-	fifteen_19 = float(tab['United States!!Total!!Estimate'][5])
-	twenty_24 = float(tab['United States!!Total!!Estimate'][6])
-	twentyfive_29 = float(tab['United States!!Total!!Estimate'][7])
-	thirty_34 = float(tab['United States!!Total!!Estimate'][8])
-	thirtyfive_39 = float(tab['United States!!Total!!Estimate'][9])
-	forty_44 = float(tab['United States!!Total!!Estimate'][10])
-	fortyfive_49 = float(tab['United States!!Total!!Estimate'][11])
-	fifty_54 = float(tab['United States!!Total!!Estimate'][12])
-	fiftyfive_59 = float(tab['United States!!Total!!Estimate'][13])
-	sixty_64 = float(tab['United States!!Total!!Estimate'][14])
-	sixtyfive_69 = float(tab['United States!!Total!!Estimate'][15])
-	seventy_74 = float(tab['United States!!Total!!Estimate'][16])
-	seventyfive_79 = float(tab['United States!!Total!!Estimate'][17])
-	eighty_84 = float(tab['United States!!Total!!Estimate'][18])
-	eightyfiveplus = float(tab['United States!!Total!!Estimate'][19])
-
-	population_percentages=np.array([under_5, five_9, ten_14, fifteen_19, twenty_24, twentyfive_29, thirty_34, thirtyfive_39, forty_44, fortyfive_49, fifty_54, fiftyfive_59, sixty_64, sixtyfive_69, seventy_74, seventyfive_79, eighty_84, eightyfiveplus],dtype=int)
-	return total, population_percentages
+	total, population_percentages = census_estimates(tab)
+	return total, population_percentages.astype(int)
 
 def get_pop_percentages(tab):
 
@@ -298,30 +1915,8 @@ def get_pop_percentages(tab):
 	206 	S0101_C01_018E 		Total!!Estimate!!AGE!!80 to 84 years
 	218 	S0101_C01_019E 		Total!!Estimate!!AGE!!85 years and over
 	'''
-
-	total = int(tab['S0101_C01_001E'][1])
-
-	under_5 = float(tab['S0101_C01_002E'][1])
-	five_9 = float(tab['S0101_C01_003E'][1])
-	ten_14 = float(tab['S0101_C01_004E'][1])
-	fifteen_19 = float(tab['S0101_C01_005E'][1])
-	twenty_24 = float(tab['S0101_C01_006E'][1])
-	twentyfive_29 = float(tab['S0101_C01_007E'][1])
-	thirty_34 = float(tab['S0101_C01_008E'][1])
-	thirtyfive_39 = float(tab['S0101_C01_009E'][1])
-	forty_44 = float(tab['S0101_C01_010E'][1])
-	fortyfive_49 = float(tab['S0101_C01_011E'][1])
-	fifty_54 = float(tab['S0101_C01_012E'][1])
-	fiftyfive_59 = float(tab['S0101_C01_013E'][1])
-	sixty_64 = float(tab['S0101_C01_014E'][1])
-	sixtyfive_69 = float(tab['S0101_C01_015E'][1])
-	seventy_74 = float(tab['S0101_C01_016E'][1])
-	seventyfive_79 = float(tab['S0101_C01_017E'][1])
-	eighty_84 = float(tab['S0101_C01_018E'][1])
-	eightyfiveplus = float(tab['S0101_C01_019E'][1])
-
-	population_percentages=np.array([under_5, five_9, ten_14, fifteen_19, twenty_24, twentyfive_29, thirty_34, thirtyfive_39, forty_44, fortyfive_49, fifty_54, fiftyfive_59, sixty_64, sixtyfive_69, seventy_74, seventyfive_79, eighty_84, eightyfiveplus],dtype=int)
-	return total, population_percentages
+	total, population_percentages = census_estimates(tab)
+	return total, population_percentages.astype(int)
 
 
 def get_pop_percentages_F15(tab):
@@ -347,41 +1942,17 @@ def get_pop_percentages_F15(tab):
 	206 	S0101_C01_018E 		Total!!Estimate!!AGE!!80 to 84 years
 	218 	S0101_C01_019E 		Total!!Estimate!!AGE!!85 years and over
 	'''
-
-	total = int(tab['S0101_C01_001E'][1])
-
-	under_5 = float(tab['S0101_C01_002E'][1])
-	five_9 = float(tab['S0101_C01_003E'][1])
-	ten_14 = float(tab['S0101_C01_004E'][1])
-	fifteen_19 = float(tab['S0101_C01_005E'][1])
-	twenty_24 = float(tab['S0101_C01_006E'][1])
-	twentyfive_29 = float(tab['S0101_C01_007E'][1])
-	thirty_34 = float(tab['S0101_C01_008E'][1])
-	thirtyfive_39 = float(tab['S0101_C01_009E'][1])
-	forty_44 = float(tab['S0101_C01_010E'][1])
-	fortyfive_49 = float(tab['S0101_C01_011E'][1])
-	fifty_54 = float(tab['S0101_C01_012E'][1])
-	fiftyfive_59 = float(tab['S0101_C01_013E'][1])
-	sixty_64 = float(tab['S0101_C01_014E'][1])
-	sixtyfive_69 = float(tab['S0101_C01_015E'][1])
-	seventy_74 = float(tab['S0101_C01_016E'][1])
-	seventyfive_79 = float(tab['S0101_C01_017E'][1])
-	eighty_84 = float(tab['S0101_C01_018E'][1])
-	eightyfiveplus = float(tab['S0101_C01_019E'][1])
-
-	population_percentages=np.array([under_5, five_9, ten_14, fifteen_19, twenty_24, twentyfive_29, thirty_34, thirtyfive_39, forty_44, fortyfive_49, fifty_54, fiftyfive_59, sixty_64, sixtyfive_69, seventy_74, seventyfive_79, eighty_84, eightyfiveplus],dtype=float)
+	total, population_percentages = census_estimates(tab)
 	return total, population_percentages
 
 
 
 ##### make time series data from census data:
 def make_population_series(total,year_,time_series):
-	population_series = np.array([],dtype=int)
-	t_series = np.array([])
-	for x in time_series:
-		if x[0:4]==str(year_):
-			population_series= np.append(population_series, int(total))
-			t_series = np.append(t_series, x)
+	''' total repeated on every month of year_, and these months of time_series'''
+	year_months = MonthIndex(time_series).year_mask(year_)
+	population_series = np.full(int(np.sum(year_months)), int(total), dtype=int)
+	t_series = np.asarray(time_series)[year_months]
 	return population_series, t_series
 
 
@@ -398,45 +1969,33 @@ mortality functions
 multivariate analysis
 '''
 
-def get_two_column(source_dir,bigData,var1,var2):
-	tab = bigData[['date', var1,var2]].copy()
-	tab = tab.dropna(subset=[var1,var2,'date'])
-	dict1 = pd.read_excel(source_dir+'CDC_database_codeNames.xlsx')
-	cod_of_int1 = dict1.Code[dict1.Code==var1]
-	cod_of_int2 = dict1.Code[dict1.Code==var2]
-	var_of_int1 = dict1.Label[dict1.Code==var1]
-	var_of_int2 = dict1.Label[dict1.Code==var2]
-	print(	cod_of_int1.values[0], var_of_int1.values[0], '\n',
-			cod_of_int2.values[0], var_of_int2.values[0])
+def get_two_column(source_dir,bigData,var1,var2,view=False):
+	## view=True: no copy, a ColumnSelection (column references + null mask) for the counting functions
+	if view:
+		tab = ColumnSelection(bigData, ['date', var1, var2])
+	else:
+		tab = bigData[['date', var1,var2]].copy()
+		tab = tab.dropna(subset=[var1,var2,'date'])
+	codebook = get_codebook(source_dir)
+	codes = [var1, var2]
+	labes = [codebook.label(code) for code in codes]
+	print(	codes[0], labes[0], '\n',
+			codes[1], labes[1])
 
-	codes = [cod_of_int1.values[0],cod_of_int2.values[0]]
-	labes = [var_of_int1.values[0],var_of_int2.values[0]]
 	return tab, labes, codes
 
 
-def get_plus_column(source_dir,bigData,var1,var2,var3,var4,var5,dvar):
-	tab = bigData[['date', var1,var2,var3,var4,var5,dvar]].copy()
-	tab = tab.dropna(subset=[var1,var2,var3,var4,var5,dvar,'date'])
-	dict1 = pd.read_excel(source_dir+'CDC_database_codeNames.xlsx')
-	cod_of_int1 = dict1.Code[dict1.Code==var1]
-	cod_of_int2 = dict1.Code[dict1.Code==var2]
-	cod_of_int3 = dict1.Code[dict1.Code==var3]
-	cod_of_int4 = dict1.Code[dict1.Code==var4]
-	cod_of_int5 = dict1.Code[dict1.Code==var5]
-	cod_of_dvar = dict1.Code[dict1.Code==dvar]
-	var_of_int1 = dict1.Label[dict1.Code==var1]
-	var_of_int2 = dict1.Label[dict1.Code==var2]
-	var_of_int3 = dict1.Label[dict1.Code==var3]
-	var_of_int4 = dict1.Label[dict1.Code==var4]
-	var_of_int5 = dict1.Label[dict1.Code==var5]
-	var_of_dvar = dict1.Label[dict1.Code==dvar]
-	print(	cod_of_int1.values[0], var_of_int1.values[0], '\n',
-			cod_of_int2.values[0], var_of_int2.values[0], '\n',
-			cod_of_int2.values[0], var_of_int3.values[0], '\n',
-			cod_of_int2.values[0], var_of_int4.values[0], '\n',
-			cod_of_int2.values[0], var_of_int5.values[0], '\n',
-			cod_of_int2.values[0], var_of_dvar.values[0])
-
-	codes = [cod_of_int1.values[0], cod_of_int2.values[0], cod_of_int3.values[0], cod_of_int4.values[0], cod_of_int5.values[0], cod_of_dvar.values[0]]
-	labes = [var_of_int1.values[0], var_of_int2.values[0], var_of_int3.values[0], var_of_int4.values[0], var_of_int5.values[0], var_of_dvar.values[0]]
+def get_plus_column(source_dir,bigData,var1,var2,var3,var4,var5,dvar,view=False):
+	## view=True: no copy, a ColumnSelection (column references + null mask) for the counting functions
+	if view:
+		tab = ColumnSelection(bigData, ['date', var1,var2,var3,var4,var5,dvar])
+	else:
+		tab = bigData[['date', var1,var2,var3,var4,var5,dvar]].copy()
+		tab = tab.dropna(subset=[var1,var2,var3,var4,var5,dvar,'date'])
+	codebook = get_codebook(source_dir)
+	codes = [var1, var2, var3, var4, var5, dvar]
+	labes = [codebook.label(code) for code in codes]
+	for code, label in zip(codes, labes):
+		print(code, label)
+
 	return tab, labes, codes
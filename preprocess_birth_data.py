@@ -12,14 +12,14 @@ This script takes as input the *csv file downloaded from the NBR website:
 
 Considerations:
 - Script assumes that there's a child directory named csv_data, where all the downloaded files are stored.
-- Files sometimes are downloaded as *zip, in such case, it'll be necessary to unzip to access the file
+- Files sometimes are downloaded as *zip, the chunked ingest reads them (and *gz) without unzipping
 - Arrange code/directories accordingly.
 
 
 Instructions:
 - Make new directory, named csv_data
 - In the new directory, Download data from website and specific years above
-- Unzip files if necessary
+- Unzip files if necessary (only for ingest_mode = 'full')
 - run preprocess_birth_data.py
 - run covidbirth.py
 - run mathbirths.py
@@ -35,6 +35,7 @@ compared to running and loading the csv file of each year individually (10 minut
 
 '''
 
+import ninja_functions
 ## libraries
 import numpy as np
 import matplotlib.pyplot as plt
@@ -54,149 +55,256 @@ plt.rc('font', **font)
 plt.rcParams['agg.path.chunksize'] = 1000
 ## 
 data_dir = 'csv_data/'
+source_dir = 'documentation/'
 tik = time.perf_counter()
 
-####### DOCUMENTING APPROACH: FIRST LOAD A BUNCH OF DATA
-########### 1. Import data
-#######
-tic = time.perf_counter()
-b15 = pd.read_csv(data_dir+'natl2015.csv', low_memory=False, dtype=str)
-toc = time.perf_counter()
-DT= (toc-tic)/60
-DT_= '%.2f' % DT
-print('read b15, time: ',DT_,' minutes')
-
-#######
-tic = time.perf_counter()
-b16 = pd.read_csv(data_dir+'natl2016.csv', low_memory=False, dtype=str)
-toc = time.perf_counter()
-DT= (toc-tic)/60
-DT_= '%.2f' % DT
-print('read b16, time: ',DT_,' minutes')
-
-#######
-tic = time.perf_counter()
-b17 = pd.read_csv(data_dir+'natl2017.csv', low_memory=False, dtype=str)
-toc = time.perf_counter()
-DT= (toc-tic)/60
-DT_= '%.2f' % DT
-print('read b17, time: ',DT_,' minutes')
-
-#######
-tic = time.perf_counter()
-b18 = pd.read_csv(data_dir+'nat2018us.csv', low_memory=False, dtype=str)
-toc = time.perf_counter()
-DT= (toc-tic)/60
-DT_= '%.2f' % DT
-print('read b18, time: ',DT_,' minutes')
-
-#######
-tic = time.perf_counter()
-b19 = pd.read_csv(data_dir+'nat2019us.csv', low_memory=False, dtype=str)
-toc = time.perf_counter()
-DT= (toc-tic)/60
-DT_= '%.2f' % DT
-print('read b19, time: ',DT_,' minutes')
-
-#######
-tic = time.perf_counter()
-b20 = pd.read_csv(data_dir+'nat2020us.csv', low_memory=False, dtype=str)
-toc = time.perf_counter()
-DT= (toc-tic)/60
-DT_= '%.2f' % DT
-print('read b20, time: ',DT_,' minutes')
-
-#######
-tic = time.perf_counter()
-b21 = pd.read_csv(data_dir+'nat2021us.csv', low_memory=False, dtype=str)
-toc = time.perf_counter()
-DT= (toc-tic)/60
-DT_= '%.2f' % DT
-print('read b21, time: ',DT_,' minutes')
-###
-tok = time.perf_counter()
-
-#check that the first data is working
-print(b21.head())
-print(type(b21))
-
-## check time it took to load the data
-loadTime= (tok-tik)/60
-loadTime_= '%.2f' % loadTime
-print('\n Total time it took to load data: ', str(loadTime_), ' minutes. \n')
-
-################# NEXT: CLEAN OR HOMOGENIZE THE DATA FOR ANALYSIS.
-################	THE KEY OF THE APPROACH HERE IS THAT WE FIND THE COMMON NAMES
-#names are not all the same not all upper, so joining will remove some fields 
-b21.columns = b21.columns.str.upper()
-b20.columns = b20.columns.str.upper()
-b19.columns = b19.columns.str.upper()
-b18.columns = b18.columns.str.upper()
-b17.columns = b17.columns.str.upper()
-b16.columns = b16.columns.str.upper()
-b15.columns = b15.columns.str.upper()
-
-#need to combine all years but names in 2021 need to be removed and only select those that overlap in comomon with other years.
-#some names like _down are not common across fields, if you want these you will need to manually rename before this
-common_names = set(b21.columns)  # Initialize with the column names of b21
-
-## 2. Isolate common names
-# Find common names iteratively
-common_names = common_names.intersection(b20.columns)
-common_names = common_names.intersection(b15.columns)
-common_names = common_names.intersection(b16.columns)
-common_names = common_names.intersection(b17.columns)
-common_names = common_names.intersection(b18.columns)
-common_names = common_names.intersection(b19.columns)
-
-# Convert the result back to a list
-common_names = list(common_names)
+## ingest mode:
+# 'chunked' 	reads each year in bounded chunks, keeps only keep_columns and writes every chunk to the store
+# 'full' 		original approach: load every year in RAM, intersect the column names and concatenate
+ingest_mode = 'chunked'
+chunksize = 500000
+## number of years parsed in parallel (worker processes) in the chunked mode, one at a time where fork isn't available
+n_workers = ninja_functions.script_workers(min(7, os.cpu_count()))
+## only ingest year files that are new or changed since the last run (add 2022 to year_files and run again)
+incremental = True
+
+## files of each year, and the columns used downstream (covidbirth.py)
+year_files = {	'2015':'natl2015.csv', '2016':'natl2016.csv', '2017':'natl2017.csv',
+				'2018':'nat2018us.csv', '2019':'nat2019us.csv', '2020':'nat2020us.csv',
+				'2021':'nat2021us.csv'}
+keep_columns = ['DOB_YY','DOB_MM','DPLURAL','MAGER9','PREVIS_REC','MEDUC','RF_INFTR']
+## sets of columns counted together in a data cube (ninja_functions.build_data_cube)
+cube_sets = [['MAGER9','PREVIS_REC','MEDUC','RF_INFTR']]
+## count the values of every column of common_names per month, during the ingest (ninja_functions.load_value_counts)
+## these columns are then parsed by the ingest too, not only keep_columns: slower, same peak memory
+count_common_columns = True
+## columns with a bitmap index for each of their codes
+bitmap_columns = ['DPLURAL','MAGER9','PREVIS_REC','MEDUC','RF_INFTR']
+## no need to unzip: the chunked mode reads .zip/.gz downloads directly when the csv is not there
+if ingest_mode=='chunked':
+	year_files = {year_: ninja_functions.resolve_year_file(data_dir, year_files[year_]) for year_ in year_files}
+
+## outputs of the chunked mode:
+## the partitioned columnar store (read by covidbirth.py), and optionally the legacy single csv file
+store_dir = data_dir+'birth_store/'
+write_bigdata_csv = False
+bigdata_file = data_dir+'BigData_births2015to2021.csv'
+
+## header-only schema: column names of every year, without loading the data
+## some names like _down are not common across years, map them to a single name here if they are needed
+column_aliases = {}
+column_renames = {}		# e.g. {'2015': {'old_name': 'NEW_NAME'}}
+schema = ninja_functions.build_schema_registry(data_dir, year_files, column_aliases, column_renames)
+ninja_functions.save_schema_registry(schema, data_dir+'schema_registry.json')
+common_names = ninja_functions.schema_common_names(schema)
 print('common names',common_names,'\n')
 
-print(b21[common_names].head())
-
-#test that data can join
-#lazy naming for easy typing
-asd = pd.concat([b21[common_names].head(), b20[common_names].head(), 
-				b19[common_names].head(), b18[common_names].head(), 
-				b17[common_names].head(), b16[common_names].head(), 
-				b15[common_names].head()], axis=0)
-
-
-################# ANOTHER CORNERSTONE OF THE APPROACH: CONCATENATE RELEVANT DATA TO A SINGLE DATAFRAME
-################ 	THEN, REMOVE LEFTOVER DATA, AND MOVE ON.
-################	IF NECESSARY, HERE'S WHERE THINGS MIGHT HAVE TO CHANGE GIVEN DIFFERENT VARIABLES FOR STUDY
-
-#make sure this will work before running, this takes time and creates a VERY large dataframe
-asd = pd.concat([b21[common_names], b20[common_names], b19[common_names],
-				b18[common_names], b17[common_names], b16[common_names],
-				b15[common_names]], axis=0)
-
-
-frequency_table = pd.crosstab(asd['DOB_YY'], asd['DOB_MM'], dropna=False)
-
-print('\n Frequency table \n',frequency_table)
-### free up memory
-# del b21, b20, b19, b18, b17, b16, b15
-
-#convert to date for ease of plotting
-
-# Rename columns
-asd.rename(columns={'Unnamed: 0': 'date', 'Unnamed: 1': 'var1', 'Unnamed: 2': 'freq'}, inplace=True)
-
-# Convert 'DOB_YY' and 'DOB_MM' columns to strings
-asd['DOB_YY'] = asd['DOB_YY'].astype(str)
-asd['DOB_MM'] = asd['DOB_MM'].astype(str)
-
-# Combine 'DOB_YY' and 'DOB_MM' columns and create 'Date' column
-asd['date'] = pd.to_datetime(asd['DOB_YY'] + '-' + asd['DOB_MM'] + '-01', format='%Y-%m-%d')
-
-# print Large DataFrame
-print(asd)
-
-## and save up pre-processed data
-asd.to_csv(data_dir+'BigData_births2015to2021.csv')
-frequency_table.to_csv(data_dir+'frequency_table_births2015to2021.csv')
+missing_names = [name for name in keep_columns if name not in common_names]
+if len(missing_names)>0:
+	union_names = ninja_functions.schema_union(schema)
+	print('WARNING: not present in every year (filled with NaN): ', {name: union_names.get(name, []) for name in missing_names}, '\n')
+
+if ingest_mode=='chunked':
+	####### STREAMING APPROACH: ONE CHUNK AT A TIME, STRAIGHT TO DISK
+	####### peak memory is set by chunksize and n_workers, not by the number of years
+	## DOB_YY and DOB_MM are the partition keys of the store
+	store_columns = [name for name in keep_columns if name not in ['DOB_YY','DOB_MM']]
+
+	## compact dtypes of the code columns, from the codebook (int8 codes, single letter codes, ...)
+	store_dtypes = ninja_functions.get_code_schema(source_dir, store_columns)
+	print('store dtypes', store_dtypes, '\n')
+
+	## incremental: only new or changed year files (see the manifest in store_dir), else every year
+	manifest = ninja_functions.load_ingest_manifest(store_dir)
+	## value counts of every column of common_names (count_common_columns), computed in the same pass.
+	## only the switch is a setting, not the names: a new year with a different header doesn't ingest the others again
+	settings = {'keep_columns': keep_columns, 'dtypes': store_dtypes, 'count_common_columns': count_common_columns}
+	if not incremental:
+		## forget previous runs, every year is ingested again
+		manifest = {'settings': None, 'files': {}}
+	ingest_list, manifest_entries = ninja_functions.plan_incremental_ingest(manifest, data_dir, year_files, schema, settings, store_dir)
+	print('years to ingest: ', ingest_list, '\n')
+
+	## months that will change, their downstream aggregates are no longer valid
+	affected_months = [year_+'-'+month_ for year_, month_ in ninja_functions.list_partitions(store_dir, ingest_list)]
+	affected_months = affected_months+[year_+'-'+str(month_).zfill(2) for year_ in ingest_list for month_ in range(1,13)]
+
+	removed = ninja_functions.invalidate_aggregates(store_dir, set(affected_months))
+	print('invalidated aggregates: ', removed, '\n')
+
+	## every year is an independent job, parsed by one of n_workers processes
+	count_columns = common_names if count_common_columns else []
+	jobs = [(year_, data_dir+year_files[year_], schema[year_]['columns'], keep_columns, store_dir, chunksize, store_dtypes, count_columns) for year_ in ingest_list]
+	if len(jobs)>0:
+		ninja_functions.ingest_years(jobs, n_workers)
+
+	manifest['settings'] = settings
+	manifest['files'].update(manifest_entries)
+	ninja_functions.save_ingest_manifest(store_dir, manifest)
+
+	store_meta = ninja_functions.write_store_meta(store_dir, store_columns, store_dtypes)
+	frequency_table = ninja_functions.frequency_table_from_store(store_meta)
+	print('\n Frequency table \n',frequency_table)
+
+	tok = time.perf_counter()
+	loadTime= (tok-tik)/60
+	loadTime_= '%.2f' % loadTime
+	print('\n Total time it took to ingest data: ', str(loadTime_), ' minutes. \n')
+
+	frequency_table.to_csv(data_dir+'frequency_table_births2015to2021.csv')
+
+	## multivariate cubes: counts of every code combination per month, for questions like MEDUC x PREVIS_REC by month
+	## only months that are not in the cube yet are counted
+	for cube_columns in cube_sets:
+		ninja_functions.build_data_cube(store_dir, cube_columns)
+
+	## bitmap indexes of every code of bitmap_columns, for fast filtered monthly counts (ninja_functions.bitmap_count)
+	ninja_functions.build_bitmap_index(store_dir, bitmap_columns)
+	if write_bigdata_csv:
+		ninja_functions.export_store_csv(store_dir, bigdata_file)
+
+else:
+	####### DOCUMENTING APPROACH: FIRST LOAD A BUNCH OF DATA
+	########### 1. Import data
+	#######
+	tic = time.perf_counter()
+	b15 = pd.read_csv(data_dir+'natl2015.csv', low_memory=False, dtype=str)
+	toc = time.perf_counter()
+	DT= (toc-tic)/60
+	DT_= '%.2f' % DT
+	print('read b15, time: ',DT_,' minutes')
+
+	#######
+	tic = time.perf_counter()
+	b16 = pd.read_csv(data_dir+'natl2016.csv', low_memory=False, dtype=str)
+	toc = time.perf_counter()
+	DT= (toc-tic)/60
+	DT_= '%.2f' % DT
+	print('read b16, time: ',DT_,' minutes')
+
+	#######
+	tic = time.perf_counter()
+	b17 = pd.read_csv(data_dir+'natl2017.csv', low_memory=False, dtype=str)
+	toc = time.perf_counter()
+	DT= (toc-tic)/60
+	DT_= '%.2f' % DT
+	print('read b17, time: ',DT_,' minutes')
+
+	#######
+	tic = time.perf_counter()
+	b18 = pd.read_csv(data_dir+'nat2018us.csv', low_memory=False, dtype=str)
+	toc = time.perf_counter()
+	DT= (toc-tic)/60
+	DT_= '%.2f' % DT
+	print('read b18, time: ',DT_,' minutes')
+
+	#######
+	tic = time.perf_counter()
+	b19 = pd.read_csv(data_dir+'nat2019us.csv', low_memory=False, dtype=str)
+	toc = time.perf_counter()
+	DT= (toc-tic)/60
+	DT_= '%.2f' % DT
+	print('read b19, time: ',DT_,' minutes')
+
+	#######
+	tic = time.perf_counter()
+	b20 = pd.read_csv(data_dir+'nat2020us.csv', low_memory=False, dtype=str)
+	toc = time.perf_counter()
+	DT= (toc-tic)/60
+	DT_= '%.2f' % DT
+	print('read b20, time: ',DT_,' minutes')
+
+	#######
+	tic = time.perf_counter()
+	b21 = pd.read_csv(data_dir+'nat2021us.csv', low_memory=False, dtype=str)
+	toc = time.perf_counter()
+	DT= (toc-tic)/60
+	DT_= '%.2f' % DT
+	print('read b21, time: ',DT_,' minutes')
+	###
+	tok = time.perf_counter()
+
+	#check that the first data is working
+	print(b21.head())
+	print(type(b21))
+
+	## check time it took to load the data
+	loadTime= (tok-tik)/60
+	loadTime_= '%.2f' % loadTime
+	print('\n Total time it took to load data: ', str(loadTime_), ' minutes. \n')
+
+	################# NEXT: CLEAN OR HOMOGENIZE THE DATA FOR ANALYSIS.
+	################	THE KEY OF THE APPROACH HERE IS THAT WE FIND THE COMMON NAMES
+	#names are not all the same not all upper, so joining will remove some fields 
+	b21.columns = b21.columns.str.upper()
+	b20.columns = b20.columns.str.upper()
+	b19.columns = b19.columns.str.upper()
+	b18.columns = b18.columns.str.upper()
+	b17.columns = b17.columns.str.upper()
+	b16.columns = b16.columns.str.upper()
+	b15.columns = b15.columns.str.upper()
+
+	#need to combine all years but names in 2021 need to be removed and only select those that overlap in comomon with other years.
+	#some names like _down are not common across fields, if you want these you will need to manually rename before this
+	common_names = set(b21.columns)  # Initialize with the column names of b21
+
+	## 2. Isolate common names
+	# Find common names iteratively
+	common_names = common_names.intersection(b20.columns)
+	common_names = common_names.intersection(b15.columns)
+	common_names = common_names.intersection(b16.columns)
+	common_names = common_names.intersection(b17.columns)
+	common_names = common_names.intersection(b18.columns)
+	common_names = common_names.intersection(b19.columns)
+
+	# Convert the result back to a list
+	common_names = list(common_names)
+	print('common names',common_names,'\n')
+
+	print(b21[common_names].head())
+
+	#test that data can join
+	#lazy naming for easy typing
+	asd = pd.concat([b21[common_names].head(), b20[common_names].head(), 
+					b19[common_names].head(), b18[common_names].head(), 
+					b17[common_names].head(), b16[common_names].head(), 
+					b15[common_names].head()], axis=0)
+
+
+	################# ANOTHER CORNERSTONE OF THE APPROACH: CONCATENATE RELEVANT DATA TO A SINGLE DATAFRAME
+	################ 	THEN, REMOVE LEFTOVER DATA, AND MOVE ON.
+	################	IF NECESSARY, HERE'S WHERE THINGS MIGHT HAVE TO CHANGE GIVEN DIFFERENT VARIABLES FOR STUDY
+
+	#make sure this will work before running, this takes time and creates a VERY large dataframe
+	asd = pd.concat([b21[common_names], b20[common_names], b19[common_names],
+					b18[common_names], b17[common_names], b16[common_names],
+					b15[common_names]], axis=0)
+
+
+	frequency_table = pd.crosstab(asd['DOB_YY'], asd['DOB_MM'], dropna=False)
+
+	print('\n Frequency table \n',frequency_table)
+	### free up memory
+	# del b21, b20, b19, b18, b17, b16, b15
+
+	#convert to date for ease of plotting
+
+	# Rename columns
+	asd.rename(columns={'Unnamed: 0': 'date', 'Unnamed: 1': 'var1', 'Unnamed: 2': 'freq'}, inplace=True)
+
+	# Convert 'DOB_YY' and 'DOB_MM' columns to strings
+	asd['DOB_YY'] = asd['DOB_YY'].astype(str)
+	asd['DOB_MM'] = asd['DOB_MM'].astype(str)
+
+	# Combine 'DOB_YY' and 'DOB_MM' columns and create 'Date' column
+	asd['date'] = pd.to_datetime(asd['DOB_YY'] + '-' + asd['DOB_MM'] + '-01', format='%Y-%m-%d')
+
+	# print Large DataFrame
+	print(asd)
+
+	## and save up pre-processed data
+	asd.to_csv(bigdata_file)
+	frequency_table.to_csv(data_dir+'frequency_table_births2015to2021.csv')
 
 
 # ############ next script in pipeline: process_covidBirth_data.py
@@ -215,6 +323,6 @@ frequency_table.to_csv(data_dir+'frequency_table_births2015to2021.csv')
 
 
 ## next steps:
-# make a function that takes in a string input and returns a plot of that var as a function of time
+# make a function that takes in a string input and returns a plot of that var as a function of time (query_variable.py)
 # make a function that queries the code names of this database
 # 
\ No newline at end of file
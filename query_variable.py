@@ -0,0 +1,103 @@
+'''
+Monthly series of any CDC variable, on demand
+
+Takes one or more variable codes of the CDC birth database (e.g. MAGER9 DMAR CIG0_R) and returns,
+for every code of the variable, its number of births per month and its share of the births of the month.
+Only the columns of these variables are read from the store written by preprocess_birth_data.py
+(variables that are not in keep_columns come from the value counts of the ingest, see count_common_columns in preprocess_birth_data.py).
+
+Results are kept in an on-disk cache (query_cache/ in the store, the cache_size most recently used queries):
+a repeated query returns immediately, and the cache is left aside as soon as the store changes.
+
+Usage:
+	python query_variable.py MAGER9
+	python query_variable.py MAGER9 DMAR --years 2019 2020 2021 --csv model_data/queries/
+	python query_variable.py RF_INFTR --no-plot
+
+A figure per variable is saved in output_figures/query_<VARIABLE>.png
+'''
+
+import ninja_functions
+## libraries
+import numpy as np
+import matplotlib.pyplot as plt
+import pandas as pd 
+import os
+import argparse
+
+## graphics stuff
+import matplotlib as mpl
+mpl.rcParams['axes.linewidth']=0
+font = {'weight':'normal','size':25}
+plt.rc('font', **font)
+legend_font = {'size': 12, 'weight': 'normal'}
+
+### nativity
+source_dir = 'covidbirth/documentation/'
+store_dir = 'covidbirth/csv_data/birth_store/'
+cache_dir = store_dir+'query_cache/'
+cache_size = 64
+
+
+def query_table(result, births_series, label=None):
+	''' births and share of births of every code, one row per month'''
+	table = pd.DataFrame({'date': result['time_series']})
+	births = births_series.reindex(result['time_series']).to_numpy()
+	for code, series in zip(result['codes'], result['series']):
+		name = str(code) if label is None else str(code)+' '+label.get(str(code), '')
+		table[name.strip()] = series
+		table[name.strip()+' share'] = series/births
+	return table
+
+def plot_query(var1, result, births_series, title, code_labels, file_path):
+	f0=plt.figure(figsize=(20,20))
+	ax0=f0.add_subplot(211)
+	ax1=f0.add_subplot(212)
+	births = births_series.reindex(result['time_series']).to_numpy()
+	for code, series in zip(result['codes'], result['series']):
+		label = str(code)+' '+code_labels.get(str(code), '')
+		ax0.plot(result['time_series'], series, label=label.strip())
+		ax1.plot(result['time_series'], series/births, label=label.strip())
+	ax0.set_ylabel('births')
+	ax1.set_ylabel('share of births')
+	ax0.set_title(title)
+	p1=ax0.get_xticks()
+	ax0.set_xticks(np.arange(p1[0],p1[-1],12))
+	ax1.set_xticks(np.arange(p1[0],p1[-1],12))
+	f0.autofmt_xdate(rotation=45)
+	ax0.legend(prop=legend_font, ncol=4)
+	f0.savefig(file_path)
+	plt.close('all')
+
+
+if __name__=='__main__':
+	parser = argparse.ArgumentParser(description='monthly series of CDC birth variables, read from the preprocessed store')
+	parser.add_argument('variables', nargs='+', help='variable codes, e.g. MAGER9 DMAR')
+	parser.add_argument('--years', nargs='+', default=None, help='years to read (all by default)')
+	parser.add_argument('--csv', default=None, help='directory where to write a csv per variable')
+	parser.add_argument('--no-plot', action='store_true', help='do not save the figures')
+	parser.add_argument('--no-cache', action='store_true', help='read the store even if the query is cached')
+	args = parser.parse_args()
+
+	codebook = ninja_functions.get_codebook(source_dir)
+	try:
+		results = ninja_functions.query_variables(store_dir, args.variables, args.years,
+								None if args.no_cache else cache_dir, cache_size)
+	except ValueError as error:
+		## a variable that is neither stored nor counted by the ingest (see count_common_columns in preprocess_birth_data.py)
+		parser.error(str(error)+'. available variables: '+' '.join(ninja_functions.queryable_variables(store_dir)))
+	time_series, births = ninja_functions.monthly_births(store_dir, args.years)
+	births_series = pd.Series(births, index=time_series)
+
+	for var1, result in results.items():
+		title = var1+' - '+codebook.label(var1) if var1 in codebook else var1
+		code_labels = {str(code): label for code, label in (codebook.code_labels(var1) or {}).items()}
+		table = query_table(result, births_series, code_labels)
+		print(title, '\n')
+		print(table.to_string(index=False), '\n')
+		if args.csv is not None:
+			os.makedirs(args.csv, exist_ok=True)
+			table.to_csv(os.path.join(args.csv, 'query_'+var1+'.csv'), index=False)
+		if not args.no_plot:
+			os.makedirs('output_figures/', exist_ok=True)
+			plot_query(var1, result, births_series, title, code_labels, 'output_figures/query_'+var1+'.png')
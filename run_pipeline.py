@@ -0,0 +1,80 @@
+'''
+Pipeline runner
+
+Runs the stages of the pipeline in order, and only the ones whose inputs changed:
+	ingest 		preprocess_birth_data.py	CDC csv files -> columnar store (csv_data/birth_store/)
+	aggregation covidbirth.py				store -> monthly series, derived metrics and figures (model_data/, output_figures/)
+	modeling 	math_births.py				time-series store -> model and figures (model_output/)
+
+Every stage has a fingerprint: a checksum of its script, of the functions of ninja_functions.py it uses
+(and the ones they call) and of its inputs.
+A stage is skipped when its fingerprint is the one of its last successful run and its outputs exist,
+so editing a figure of math_births.py only runs the modeling stage, without reloading the births.
+The time-series store keeps its version when the aggregation gives the same series, so the modeling stage
+doesn't run again after an aggregation that changed nothing.
+The fingerprints are kept in pipeline_state.json.
+
+Usage:
+	python run_pipeline.py 					run the stages that changed
+	python run_pipeline.py --force aggregation 	run aggregation even if nothing changed
+	python run_pipeline.py --dry-run 			list the stages that would run
+
+'''
+
+import ninja_functions
+## libraries
+import os
+import argparse
+import time
+
+from datetime import datetime
+
+#################################################################################### stages
+## paths are relative to the directory of this script, cwd is where the script runs
+## (preprocess_birth_data.py runs in covidbirth/, next to csv_data/ and documentation/)
+## the ingest takes the store dtypes from the codebook, but not the other documentation files (keyDates)
+stages = [
+	{'name': 'ingest', 'script': 'preprocess_birth_data.py', 'cwd': 'covidbirth/', 'modules': ['ninja_functions.py'],
+		'inputs': ['covidbirth/csv_data/nat*', 'covidbirth/documentation/CDC_database_codeNames.xlsx'],
+		'outputs': ['covidbirth/csv_data/birth_store/store_meta.json']},
+	{'name': 'aggregation', 'script': 'covidbirth.py', 'cwd': '.', 'modules': ['ninja_functions.py'],
+		'inputs': ['covidbirth/csv_data/birth_store/store_meta.json', 'covidbirth/csv_data/birth_store/ingest_manifest.json',
+					'covidbirth/documentation/*.xlsx', 'census_data/*.csv'],
+		'outputs': ['model_data/series_store/current.json', 'model_data/series_metrics.npz', 'output_figures/figure4.png']},
+	{'name': 'modeling', 'script': 'math_births.py', 'cwd': '.', 'modules': ['ninja_functions.py'],
+		'inputs': ['model_data/series_store/current.json'],
+		'outputs': ['model_output/f1_full_model_.png']},
+]
+base_dir = os.path.dirname(os.path.abspath(__file__))
+state_file = os.path.join(base_dir, 'pipeline_state.json')
+
+
+if __name__=='__main__':
+	parser = argparse.ArgumentParser(description='run the stages of the birth_season pipeline that changed')
+	parser.add_argument('--force', nargs='+', default=[], choices=[stage['name'] for stage in stages],
+						help='stages to run even if their inputs did not change')
+	parser.add_argument('--dry-run', action='store_true', help='only list the stages that would run')
+	args = parser.parse_args()
+
+	state = ninja_functions.load_pipeline_state(state_file)
+	for stage in stages:
+		## the fingerprint is computed when the stage comes: it sees the outputs of the stages that just ran
+		if ninja_functions.stage_is_current(stage, state, base_dir) and stage['name'] not in args.force:
+			print('stage ', stage['name'], ': up to date')
+			continue
+		if args.dry_run:
+			print('stage ', stage['name'], ': would run (and the stages that use its outputs)')
+			continue
+
+		print('stage ', stage['name'], ': running ', stage['script'])
+		## fingerprint of the inputs the stage runs on
+		fingerprint = ninja_functions.stage_fingerprint(stage, base_dir)
+		tik = time.perf_counter()
+		exit_code = ninja_functions.run_stage(stage, base_dir)
+		DT_ = '%.2f' % ((time.perf_counter()-tik)/60)
+		if exit_code!=0:
+			print('stage ', stage['name'], ' failed (exit code ', exit_code, '), time: ', DT_, ' minutes')
+			raise SystemExit(exit_code)
+		state[stage['name']] = {'fingerprint': fingerprint, 'finished': datetime.now().isoformat(timespec='seconds')}
+		ninja_functions.save_pipeline_state(state_file, state)
+		print('stage ', stage['name'], ': done, time: ', DT_, ' minutes \n')